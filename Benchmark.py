@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import argparse
+import json
+import os
+import os.path as osp
+import sys
+import time
+import tracemalloc
+from collections import Counter
+import cv2
+import numpy as np
+from src.CaptureBackend import FakeCaptureBackend
+from src.Calculator import Calculator
+from src.GlyphCache import GlyphCache
+from src.InputBackend import RecordingInputBackend, create_input_backend
+from src.OCRExecutor import create_ocr_executor
+from src.PlayerAgent import PlayerAgent
+from src.Recognizer import Recognizer
+from src.utils.AnalyUtils import LatencyHistogram
+from src.utils.Config import PerformanceLevel
+
+STAGES = ('capture', 'segment', 'match', 'solve', 'draw')
+OCR_MODES = ('inline', 'thread', 'process')
+IMAGE_EXT = ('.png', '.jpg')
+SYNTHETIC_QUESTIONS = ('12A34EU', '5U3', '7M2EU', '100A200EU', '9U9', '86M47EU', '3A5EU', '1000U999')
+SYNTHETIC_SCALES = (1.0, 1.5, 2.0)
+# Freelists of the interpreter keep a few small objects alive, while leaking even one object per frame exceeds this
+ALLOC_GROWTH_LIMIT = 16 # bytes per frame
+
+
+def load_frames(path:str):
+    """Loads the recorded frames from a directory of images or a video file.
+
+    :param path: The path to the directory or the video file;
+    :returns: A list of tuples of the frame name and the BGR image;
+    :rtype: list;
+    """
+    if osp.isdir(path):
+        return [(i, cv2.imread(osp.join(path, i), cv2.IMREAD_COLOR)) for i in sorted(os.listdir(path))
+                if osp.splitext(i)[1].lower() in IMAGE_EXT]
+    frames = []
+    video = cv2.VideoCapture(path)
+    while True:
+        ok, image = video.read()
+        if not ok:
+            break
+        frames.append((str(len(frames)), image))
+    video.release()
+    if not frames:
+        raise ValueError(f"No frames can be read from '{path}'")
+    return frames
+
+
+def synthesize_frames(questions:tuple=SYNTHETIC_QUESTIONS, scales:tuple=SYNTHETIC_SCALES):
+    """Renders question region crops from the char templates, so the benchmark can run without recorded frames.
+    Every question is rendered at every scale, which covers the size buckets of the template bank.
+
+    :param questions: The question strings;
+    :param scales: The scale factors of the glyphs;
+    :returns: A tuple of the frames in the format of `load_frames` and the ground truth in the format of `load_labels`;
+    :rtype: tuple;
+    """
+    templates = Recognizer.T_CHARS.data
+    height = max(i.shape[0] for i in templates.values())
+    frames, labels = [], {}
+    for scale in scales:
+        for question in questions:
+            parts = []
+            for char in question:
+                glyph = templates[char]
+                glyph = np.pad(glyph, ((0, height - glyph.shape[0]), (0, 6)), constant_values=255)
+                parts.append(glyph)
+            image = np.pad(np.hstack(parts)[:, :-6], 12, constant_values=255)
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+            name = f"synthetic-{question}-x{scale}"
+            frames.append((name, cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)))
+            labels[name] = question
+    return frames, labels
+
+
+def load_labels(path:str, frames_path:str):
+    """Loads the ground truth, a JSON dict mapping frame names (or frame indices of a video) to question strings.
+    If the path is not given, `labels.json` in the frames directory will be used if it exists.
+    """
+    if not path and osp.isdir(frames_path) and osp.isfile(osp.join(frames_path, 'labels.json')):
+        path = osp.join(frames_path, 'labels.json')
+    if not path:
+        return {}
+    with open(path, 'r', encoding='UTF-8') as f:
+        return json.load(f)
+
+
+def run(frames:list, labels:dict, window:bool=False, repeat:int=1, glyph_cache_size:int=0,
+        ocr_mode:str='inline', workers:int=1, engine:str='opencv', event_interval:float=None):
+    """Feeds the frames through the capture, recognition, solving and drawing stages.
+
+    :param frames: The frames returned by `load_frames`;
+    :param labels: The ground truth returned by `load_labels`;
+    :param window: Whether the frames are whole game window captures rather than question region crops;
+    :param repeat: The count of passes over the frames;
+    :param glyph_cache_size: The capacity of the glyph cache, `0` to disable the cache;
+    :param ocr_mode: The execution mode of the glyph matching, see `create_ocr_executor`;
+    :param workers: The count of OCR workers;
+    :param engine: The classification engine of the recognizer, see `Recognizer.ENGINES`;
+    :param event_interval: The seconds to sleep after every input event, `None` to use the default of the backend;
+    :returns: The report;
+    :rtype: dict;
+    """
+    glyph_cache = GlyphCache(glyph_cache_size) if glyph_cache_size > 0 else None
+    recog = Recognizer(glyph_cache, engine)
+    ocr = create_ocr_executor(ocr_mode, recog, workers)
+    ocr.warm_up()
+    # The cascade stats are kept by the classifier of the engine in use, which the process workers don't share
+    bank = recog.classifier(Recognizer.T_CHARS)
+    if ocr_mode == 'process' or not hasattr(bank, 'stats'):
+        bank = None
+    else:
+        bank.reset_stats()
+    calcu = Calculator()
+    capture = FakeCaptureBackend([i[1] for i in frames])
+    h, w = frames[0][1].shape[:2]
+    recorder = create_input_backend('recording', event_interval)
+    agent = PlayerAgent((0, 0), (w, h), capture, recorder)
+    agent.get_screen_image()
+
+    spans = {k: LatencyHistogram() for k in STAGES}
+    labelled = correct = solved = drawn_chars = glyphs = 0
+    mistakes = []
+    questions = []
+    begin = time.perf_counter_ns()
+    for r in range(repeat):
+        for idx, (name, frame) in enumerate(frames):
+            capture.seek(idx)
+            t0 = time.perf_counter_ns()
+            image = agent.get_screen_image(PlayerAgent.REGION_THIS_QUESTION) if window else frame
+            t1 = time.perf_counter_ns()
+            image = recog.preprocess(image, recog.frame_buffer(image.shape[:2]))
+            boxes = recog.char_boxes(image)
+            t2 = time.perf_counter_ns()
+            question = ocr.recognize_boxes(image, boxes)
+            t3 = time.perf_counter_ns()
+            glyphs += len(boxes)
+            answer = calcu.solve(question, ignore_error=True)
+            t4 = time.perf_counter_ns()
+            if answer:
+                agent.draw_answer(answer, ignore_error=True)
+            t5 = time.perf_counter_ns()
+            for k, v in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                spans[k].record(v)
+            if answer:
+                spans['draw'].record(t5 - t4)
+                solved += 1
+                drawn_chars += len(answer)
+            if r == 0:
+                questions.append(question)
+                if name in labels:
+                    labelled += 1
+                    if question == labels[name]:
+                        correct += 1
+                    else:
+                        mistakes.append({'frame': name, 'expected': labels[name], 'recognized': question})
+    elapsed = (time.perf_counter_ns() - begin) / 1e9
+    ocr.close()
+    _, codes = calcu.solve_many(questions)
+
+    if not window:
+        spans.pop('capture')
+    total = len(frames) * repeat
+    return {
+        'ocr_mode': ocr_mode,
+        'engine': engine,
+        'frames': total,
+        'glyphs': glyphs,
+        'match_us_per_glyph': spans['match'].total / glyphs / 1e3 if glyphs else None,
+        'solved': solved,
+        'elapsed_sec': elapsed,
+        'frames_per_sec': total / elapsed if elapsed > 0 else None,
+        'questions_per_sec': solved / elapsed if elapsed > 0 else None,
+        'stages': {k: v.summary() for k, v in spans.items()},
+        'accuracy': {
+            'labelled': labelled,
+            'correct': correct,
+            'rate': correct / labelled if labelled else None,
+            'mistakes': mistakes
+        },
+        'solve_errors': dict(Counter(i for i in codes if i)),
+        'draw': recorder.stats(drawn_chars),
+        'glyph_cache': glyph_cache.stats() if glyph_cache else None,
+        'cascade': dict(top_k=Recognizer.CASCADE_TOP_K, **bank.stats()) if bank else None
+    }
+
+
+def measure_allocations(frames:list, window:bool=False, engine:str='opencv', glyph_cache_size:int=0,
+                        max_warm_up:int=20, repeat:int=3, ocr_mode:str='inline', workers:int=1):
+    """Traces the memory allocated by the capture, preprocessing, segmentation and matching of each frame.
+    The frames are replayed untraced until a pass allocates no more than `ALLOC_GROWTH_LIMIT` per frame,
+    which means the reusable buffers, the lazily built tables and the glyph cache have settled.
+
+    :param frames: The frames returned by `load_frames`;
+    :param window: Whether the frames are whole game window captures rather than question region crops;
+    :param engine: The classification engine of the recognizer;
+    :param glyph_cache_size: The capacity of the glyph cache, 0 to disable;
+    :param max_warm_up: The maximum count of warm-up passes over the frames;
+    :param repeat: The count of traced passes over the frames;
+    :param ocr_mode: The execution mode of the glyph matching, the allocations of the process workers are not traced;
+    :param workers: The count of OCR workers;
+    :returns: The allocation report;
+    :rtype: dict;
+    """
+    recog = Recognizer(GlyphCache(glyph_cache_size) if glyph_cache_size > 0 else None, engine)
+    capture = FakeCaptureBackend([i[1] for i in frames])
+    h, w = frames[0][1].shape[:2]
+    agent = PlayerAgent((0, 0), (w, h), capture, RecordingInputBackend())
+    recog.classifier(Recognizer.T_CHARS)
+    ocr = create_ocr_executor(ocr_mode, recog, workers)
+    ocr.warm_up()
+
+    def process(idx:int):
+        capture.seek(idx)
+        image = agent.get_screen_image(PlayerAgent.REGION_THIS_QUESTION if window else None)
+        image = recog.preprocess(image, recog.frame_buffer(image.shape[:2]))
+        ocr.recognize_boxes(image, recog.char_boxes(image))
+
+    tracemalloc.start()
+    warm_up = 0
+    previous = None
+    while warm_up < max_warm_up:
+        for idx in range(len(frames)):
+            process(idx)
+        warm_up += 1
+        current = tracemalloc.get_traced_memory()[0]
+        if previous is not None and current - previous <= ALLOC_GROWTH_LIMIT * len(frames):
+            break
+        previous = current
+    # Taking a snapshot churns the allocator, so the growth is measured by the traced total over the passes
+    # after the first snapshot and the pass following it, while the snapshots only locate the growing sites
+    first = tracemalloc.take_snapshot()
+    for idx in range(len(frames)):
+        process(idx)
+    base, _ = tracemalloc.get_traced_memory()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    for _ in range(repeat):
+        for idx in range(len(frames)):
+            process(idx)
+    current, peak = tracemalloc.get_traced_memory()
+    last = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ocr.close()
+    count = len(frames) * repeat
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = last.filter_traces(filters).compare_to(first.filter_traces(filters), 'lineno')
+    sites = [i for i in diff if i.size_diff > 0 or i.count_diff > 0]
+    return {
+        'frames': count,
+        'engine': engine,
+        'ocr_mode': ocr_mode,
+        'glyph_cache': glyph_cache_size,
+        'warm_up_passes': warm_up,
+        'peak_bytes': peak - base,
+        'growth_bytes_per_frame': (current - base) / count,
+        'growth_sites': [f"{i.traceback}: +{i.size_diff} B, +{i.count_diff} blocks" for i in sites[:5]]
+    }
+
+
+def compare_ocr_modes(frames:list, labels:dict, window:bool=False, repeat:int=1, glyph_cache_size:int=0, workers:int=1,
+                      engine:str='opencv', event_interval:float=None):
+    """Runs the benchmark in every OCR mode and collects the throughput of the matching stage.
+
+    :returns: A tuple of the report of the inline mode and a dict mapping the modes to their throughput;
+    :rtype: tuple;
+    """
+    reports = {m: run(frames, labels, window, repeat, glyph_cache_size, m, workers, engine, event_interval)
+               for m in OCR_MODES}
+    modes = {}
+    for m, r in reports.items():
+        match = r['stages']['match']
+        modes[m] = {
+            'frames_per_sec': r['frames_per_sec'],
+            'match_per_sec': 1e3 / match['mean_ms'] if match['count'] and match['mean_ms'] > 0 else None,
+            'match_p95_ms': match.get('p95_ms', None),
+            'accuracy': r['accuracy']['rate']
+        }
+    return reports['inline'], modes
+
+
+def compare_engines(frames:list, labels:dict, window:bool=False, repeat:int=1, glyph_cache_size:int=0,
+                    ocr_mode:str='inline', workers:int=1, event_interval:float=None):
+    """Runs the benchmark with every recognizer engine and collects the accuracy and the latency per glyph.
+
+    :returns: A dict mapping the engines to their results;
+    :rtype: dict;
+    """
+    engines = {}
+    for e in Recognizer.ENGINES:
+        r = run(frames, labels, window, repeat, glyph_cache_size, ocr_mode, workers, e, event_interval)
+        engines[e] = {
+            'match_us_per_glyph': r['match_us_per_glyph'],
+            'match_p95_ms': r['stages']['match'].get('p95_ms', None),
+            'frames_per_sec': r['frames_per_sec'],
+            'accuracy': r['accuracy']['rate']
+        }
+    return engines
+
+
+def compare(report:dict, baseline:dict, tolerance:float):
+    """Compares the p95 latency of every stage with the baseline report.
+
+    :returns: A list of the regression descriptions;
+    :rtype: list;
+    """
+    regressions = []
+    for k, v in report['stages'].items():
+        old = baseline.get('stages', {}).get(k, {}).get('p95_ms', None)
+        new = v.get('p95_ms', None)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"Stage '{k}' p95 regressed: {old:.3f} ms -> {new:.3f} ms")
+    old_rate = baseline.get('accuracy', {}).get('rate', None)
+    new_rate = report['accuracy']['rate']
+    if old_rate is not None and new_rate is not None and new_rate < old_rate:
+        regressions.append(f"Accuracy regressed: {old_rate:.2%} -> {new_rate:.2%}")
+    return regressions
+
+
+def print_report(report:dict):
+    print(f"Frames: {report['frames']}, solved: {report['solved']}, "
+          f"{report['questions_per_sec']:.1f} questions/s, {report['frames_per_sec']:.1f} frames/s")
+    for k, v in report['stages'].items():
+        if v['count']:
+            print(f"  {k:<8} p50 {v['p50_ms']:8.3f} ms  p95 {v['p95_ms']:8.3f} ms  p99 {v['p99_ms']:8.3f} ms  (n={v['count']})")
+    if report['match_us_per_glyph']:
+        print(f"Engine: {report['engine']}, {report['match_us_per_glyph']:.1f} us/glyph ({report['glyphs']} glyphs)")
+    if report['solve_errors']:
+        print("Solve errors: " + ", ".join(f"{k} x{v}" for k, v in report['solve_errors'].items()))
+    if report.get('ocr_modes'):
+        print(f"OCR modes ({report['workers']} workers):")
+        for k, v in report['ocr_modes'].items():
+            print(f"  {k:<8} {v['match_per_sec']:8.1f} matches/s  p95 {v['match_p95_ms']:8.3f} ms  {v['frames_per_sec']:8.1f} frames/s")
+    if report.get('engines'):
+        print("Engines:")
+        for k, v in report['engines'].items():
+            acc = f"{v['accuracy']:.2%}" if v['accuracy'] is not None else "n/a"
+            print(f"  {k:<10} {v['match_us_per_glyph']:8.1f} us/glyph  p95 {v['match_p95_ms']:8.3f} ms  accuracy {acc}")
+    cascade = report['cascade']
+    if cascade and cascade['top_k'] > 0 and cascade['glyphs']:
+        print(f"Cascade (top {cascade['top_k']}): {cascade['pruning_rate']:.1%} templates pruned, "
+              f"{cascade['templates_per_glyph']:.2f} templates/glyph, {cascade['skip_rate']:.1%} glyphs narrowed to one template")
+    alloc = report.get('allocations', None)
+    if alloc:
+        print(f"Allocations over {alloc['frames']} frames ({alloc['engine']}, {alloc['ocr_mode']} mode, glyph cache {alloc['glyph_cache']}, "
+              f"{alloc['warm_up_passes']} warm-up passes): peak {alloc['peak_bytes']} B, "
+              f"growth {alloc['growth_bytes_per_frame']:.1f} B/frame")
+        for i in alloc['growth_sites']:
+            print(f"  {i}")
+    acc = report['accuracy']
+    if acc['labelled']:
+        print(f"Accuracy: {acc['correct']}/{acc['labelled']} ({acc['rate']:.2%})")
+        for m in acc['mistakes'][:10]:
+            print(f"  {m['frame']}: expected '{m['expected']}', recognized '{m['recognized']}'")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline replay benchmark of the AutoXYKS solve loop.")
+    parser.add_argument('frames', nargs='?', default=None, help="directory of recorded frames, or a video file, "
+                        "question crops rendered from the char templates if omitted")
+    parser.add_argument('--labels', default=None, help="JSON file mapping frame names to ground truth questions")
+    parser.add_argument('--window', action='store_true', help="frames are whole game window captures")
+    parser.add_argument('--repeat', type=int, default=1, help="count of passes over the frames")
+    parser.add_argument('--glyph-cache', type=int, default=0, help="capacity of the glyph cache, 0 to disable")
+    parser.add_argument('--ocr-mode', default='inline', choices=OCR_MODES + ('all',), help="execution mode of the glyph matching, 'all' to compare every mode")
+    parser.add_argument('--engine', default='opencv', choices=tuple(Recognizer.ENGINES) + ('all',), help="classification engine of the recognizer, 'all' to compare every engine")
+    parser.add_argument('--workers', type=int, default=PerformanceLevel.get_thread_limit(PerformanceLevel.STANDARD), help="count of OCR workers")
+    parser.add_argument('--cascade-top-k', type=int, default=Recognizer.CASCADE_TOP_K, help="count of candidates kept by the feature cascade, 0 to disable")
+    parser.add_argument('--input-event-interval', type=float, default=None, help="seconds to sleep after every input event, the default of the backend if omitted")
+    parser.add_argument('--check-alloc', action='store_true', help="trace the allocations per frame and fail on steady-state growth")
+    parser.add_argument('--json', default=None, help="path to write the machine-readable report")
+    parser.add_argument('--baseline', default=None, help="previous JSON report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative p95 increase against the baseline")
+    args = parser.parse_args()
+
+    if args.frames:
+        frames = load_frames(args.frames)
+        labels = load_labels(args.labels, args.frames)
+    else:
+        frames, labels = synthesize_frames()
+        args.window = False
+    Recognizer.CASCADE_TOP_K = max(0, args.cascade_top_k)
+    engine = 'opencv' if args.engine == 'all' else args.engine
+    if args.ocr_mode == 'all':
+        report, ocr_modes = compare_ocr_modes(frames, labels, args.window, max(1, args.repeat), args.glyph_cache, args.workers,
+                                              engine, args.input_event_interval)
+        report['ocr_modes'] = ocr_modes
+    else:
+        report = run(frames, labels, args.window, max(1, args.repeat), args.glyph_cache, args.ocr_mode, args.workers, engine,
+                     args.input_event_interval)
+    if args.engine == 'all':
+        report['engines'] = compare_engines(frames, labels, args.window, max(1, args.repeat), args.glyph_cache,
+                                            'inline' if args.ocr_mode == 'all' else args.ocr_mode, args.workers,
+                                            args.input_event_interval)
+    report['workers'] = args.workers
+    if args.check_alloc:
+        report['allocations'] = measure_allocations(frames, args.window, engine, args.glyph_cache,
+                                                    ocr_mode='inline' if args.ocr_mode == 'all' else args.ocr_mode,
+                                                    workers=args.workers)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as f:
+            json.dump(report, f, indent=4)
+    regressions = []
+    if args.check_alloc and report['allocations']['growth_bytes_per_frame'] > ALLOC_GROWTH_LIMIT:
+        regressions.append(f"Allocations: steady-state growth above {ALLOC_GROWTH_LIMIT} B/frame")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='UTF-8') as f:
+            regressions += compare(report, json.load(f), args.tolerance)
+    for i in regressions:
+        print(i)
+    sys.exit(1 if regressions else 0)
@@ -2,52 +2,142 @@
 # Copyright (c) 2024, Harry Huang
 # @ MIT License
 import time
-import numpy as np
-import pyautogui as pag
+LAUNCH_TIME = time.perf_counter()
+
+import argparse
+
+from src.CaptureBackend import create_capture_backend
 from src.Calculator import Calculator
-from src.GUI import IndicatorWindow
-from src.PlayerAgent import PlayerAgent, TimeGateCache
+from src.GlyphCache import GlyphCache
+from src.InputBackend import create_input_backend
+from src.Engine import Engine
+from src.OCRExecutor import create_ocr_executor
+from src.Pipeline import MultiSessionPipeline, SolvePipeline
+from src.PlayerAgent import PlayerAgent
 from src.Recognizer import Recognizer
-from src.utils.Config import Config
+from src.utils.Config import Config, PerformanceLevel
 from src.utils.Logger import Logger
 from src.utils.AnalyUtils import TestRT
 
 
 if __name__ == '__main__':
-    recog = Recognizer()
+    parser = argparse.ArgumentParser(description="AutoXYKS")
+    parser.add_argument('--headless', action='store_true', help="run without the indicator window")
+    args = parser.parse_args()
+
+    glyph_cache = GlyphCache(Config.get('glyph_cache_size'))
+    recognizer = Recognizer(glyph_cache, Config.get('recognizer_engine'))
+    glyph_cache.load(Config.get('glyph_cache_file'), recognizer.fingerprint)
+    recog = create_ocr_executor(Config.get('ocr_mode'), recognizer,
+                                PerformanceLevel.get_thread_limit(Config.get('performance_level')))
+    recog.warm_up()
     calcu = Calculator()
-    agent = PlayerAgent(*tuple(Config.get('region')))
-    # agent = PlayerAgent((800, 225), (1100, 300))
-    this_cache = TimeGateCache(expire_time=2.5)
+    regions = Config.get('regions')
+    if regions:
+        # Multi-session mode, each region is a game window
+        pipeline = MultiSessionPipeline(regions, recog, calcu,
+                                        create_capture_backend(Config.get('capture_backend')),
+                                        create_input_backend(Config.get('input_backend'), Config.get('input_event_interval')),
+                                        Config.get('performance_level'),
+                                        expire_time=Config.get('answer_expire_time'),
+                                        max_interval=Config.get('poll_max_interval'),
+                                        trigger=Config.get('capture_trigger'),
+                                        calibrate_every=Config.get('calibrate_every'))
+    else:
+        agent = PlayerAgent(*tuple(Config.get('region')),
+                            create_capture_backend(Config.get('capture_backend')),
+                            create_input_backend(Config.get('input_backend'), Config.get('input_event_interval')))
+        # agent = PlayerAgent((800, 225), (1100, 300))
+        pipeline = SolvePipeline(agent, recog, calcu, expire_time=Config.get('answer_expire_time'),
+                                 max_interval=Config.get('poll_max_interval'), stream_draw=Config.get('stream_draw'),
+                                 trigger=Config.get('capture_trigger'), calibrate_every=Config.get('calibrate_every'))
+
+    engine = Engine(pipeline)
+    region_changes = 0
+    calibrations = 0
+
+    def _region_text():
+        return "\n".join(f"{tuple(lt)}-{tuple(rb)}" for lt, rb in pipeline.regions)
+
+    def _region_changed(status:dict):
+        global region_changes
+        if status['region_changes'] == region_changes:
+            return False
+        region_changes = status['region_changes']
+        return True
+
+    def _save_regions(status:dict):
+        # Persists the regions only after a calibration requested by the user, never after the drift tracking
+        global calibrations
+        if status['calibrations'] == calibrations:
+            return
+        calibrations = status['calibrations']
+        regions = [[list(lt), list(rb)] for lt, rb in pipeline.regions]
+        if Config.get('regions'):
+            Config.set('regions', regions)
+        else:
+            Config.set('region', regions[0])
+        Config.save_config()
 
-    def _loop():
-        global recog, calcu, agent, ui
+    def _startup():
+        TestRT.record('startup', int((time.perf_counter() - LAUNCH_TIME) * 1e9))
+        Logger.info(f"Startup took {(time.perf_counter() - LAUNCH_TIME) * 1000:.0f} ms")
+        if Config.get('metrics_file'):
+            TestRT.start_exporter(Config.get('metrics_file'), Config.get('metrics_interval'))
+        engine.start()
+
+    if args.headless:
+        def _log_status(status:dict):
+            if _region_changed(status):
+                Logger.info(f"Status: Game region changed to {_region_text()}")
+            Logger.info(f"Status: {status['answered']} answered, {status['questions_per_min']:.1f} questions/min, "
+                        f"last {status['question']} (Answer: {status['answer']})")
+
+        engine.subscribe(10, _log_status)
+        _startup()
         try:
-            this_image = agent.get_screen_image(PlayerAgent.REGION_THIS_QUESTION)
-            if np.average(this_image) > 196 and np.min(this_image) < 24:
-                Logger.debug("Recognizing")
-                this_qst = recog.recognize(this_image)
-                this_ans = calcu.solve(this_qst, ignore_error=True)
-                if this_qst and this_ans and this_cache.update(this_qst.replace('U', '')):
-                    while not agent.is_async_draw_idle():
-                        time.sleep(0.001)
-                    Logger.info(f"Question: {''.join(this_qst)} (Answer: {this_ans})")
-                    agent.async_draw_answer(this_ans, ignore_error=True)
-                    ui.set_label_text(f"{''.join(this_qst)}\n{this_ans}")
-                    time.sleep(0.2)
-        except pag.FailSafeException:
-            Logger.error("FailSafe triggered")
-            exit()
-        except Exception as arg:
-            # raise arg
-            Logger.warn(f"{type(arg).__name__}: {arg}")
-
-    def _setting():
-        print("Setting is WIP")
-
-    ui = IndicatorWindow()
-    ui.set_loop_trigger(_loop, 0.01)
-    ui.set_click_setting_trigger(_setting)
-    ui.set_label_text(f"监测区域：\n{agent._lt}-{agent._rb}")
-    ui.run()
+            engine.wait()
+        except KeyboardInterrupt:
+            pass
+        engine.stop()
+    else:
+        from src.GUI import IndicatorWindow
+        subscription = engine.subscribe(0.2)
+
+        def _loop():
+            global ui
+            status = subscription.poll()
+            if status is None:
+                return
+            if not status['running']:
+                ui.root.quit()
+                return
+            _save_regions(status)
+            if _region_changed(status):
+                ui.set_label_text(f"监测区域：\n{_region_text()}")
+                return
+            if status['question']:
+                prefix = f"[{status['session'] + 1}] " if status['session'] is not None else ""
+                ui.set_label_text(f"{prefix}{status['question']}\n{status['answer']}\n"
+                                  f"{status['questions_per_min']:.1f} 题/分")
+
+        def _toggle_pause(paused:bool):
+            engine.send(Engine.CTRL_PAUSE if paused else Engine.CTRL_RESUME)
+
+        def _setting():
+            engine.send(Engine.CTRL_CALIBRATE)
+
+        ui = IndicatorWindow()
+        ui.set_loop_trigger(_loop, 0.05)
+        ui.set_toggle_pause_trigger(_toggle_pause)
+        ui.set_click_setting_trigger(_setting)
+        ui.set_label_text(f"监测区域：\n{_region_text()}")
+        _startup()
+        ui.run()
+        engine.stop()
+    recog.close()
+    TestRT.stop_exporter()
+    glyph_cache.save(Config.get('glyph_cache_file'), recognizer.fingerprint)
+    Logger.info(f"Glyph cache: {glyph_cache.stats()}")
+    Logger.info(f"Pipeline: {pipeline.stats()}")
     print(TestRT.get_avg_time_all())
@@ -1,6 +1,25 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2024, Harry Huang
 # @ MIT License
+import re
+from fractions import Fraction
+from functools import lru_cache
+
+
+class CalculatorError(ValueError):
+    """Error raised when a problem cannot be solved, carrying one of the error codes below."""
+
+    EMPTY = 'empty'
+    UNKNOWN_TOKEN = 'unknown_token'
+    SYNTAX = 'syntax'
+    AMBIGUOUS = 'ambiguous'
+    UNSOLVABLE = 'unsolvable'
+    DIVISION_BY_ZERO = 'division_by_zero'
+
+    def __init__(self, code:str, message:str):
+        super().__init__(message)
+        self.code = code
+
 
 class Calculator:
     _ADD = 'A'
@@ -10,6 +29,16 @@ class Calculator:
     _EQU = 'E'
     _UNK = 'U'
     _OPERS = _ADD + _MNS + _TMS + _DVD
+    _SYMBOLS = _OPERS + _EQU + _UNK
+    _PRECEDENCE = {_ADD: 1, _MNS: 1, _TMS: 2, _DVD: 2}
+    # Fast paths of the most common problems, which skip the tokenizer and the parser
+    _FAST_COMPARISON = re.compile(r'([0-9]+)U([0-9]+)')
+    _FAST_ADD_MNS = re.compile(r'([0-9]+)([AM])([0-9]+)EU?')
+
+    # Node kinds of the compiled expression tree,
+    # a node is either `(_N_NUM, value)`, `(_N_UNK,)` or `(operator, left_node, right_node)`
+    _N_NUM = '#'
+    _N_UNK = _UNK
 
     def __init__(self):
         pass
@@ -17,85 +46,170 @@ class Calculator:
     def solve(self, problem:str, ignore_error:bool=False):
         try:
             if not problem:
-                raise ValueError("Argument problem is empty")
-
-            # Separate numbers and signs
-            splitted = []
-            pending_num = ""
-            pending_no_num = ""
-            for i in problem:
-                if i.isnumeric():
-                    pending_num += i
-                    pending_no_num = ""
-                else:
-                    if pending_num:
-                        splitted.append(float(pending_num))
-                    if i not in pending_no_num:
-                        if i in Calculator._OPERS or i in Calculator._EQU or i in Calculator._UNK:
-                            splitted.append(i)
-                    pending_num = ""
-                    pending_no_num += i
-            if pending_num:
-                splitted.append(float(pending_num))
-
-            if Calculator._EQU not in splitted:
-                if Calculator._UNK not in splitted:
-                    raise ValueError("Not a comparison problem: no unknown sign found")
-                # Assert comparison problem
-                if len(splitted) != 3:
-                    raise ValueError("Not a comparison problem: must have 3 elements")
-                if splitted[1] != Calculator._UNK:
-                    raise ValueError("Not a comparison problem: middle element must be an unknown sign")
-                if not isinstance(splitted[0], float) or not isinstance(splitted[2], float):
-                    raise ValueError("Not a comparison problem: comparison objects must be numbers")
-
-                if splitted[0] > splitted[2]:
+                raise CalculatorError(CalculatorError.EMPTY, "Argument problem is empty")
+            kind, left, right = Calculator.compile(Calculator.tokenize(problem))
+            if kind == Calculator._EQU:
+                return self.cvt_to_str(self._solve_equation(left, right))
+            else:
+                left_value = self._eval_expr(left)
+                right_value = self._eval_expr(right)
+                if left_value > right_value:
                     return '>'
-                elif splitted[0] < splitted[2]:
+                elif left_value < right_value:
                     return '<'
                 else:
                     return '='
-            else:
-                # Assert equation problem
-                if splitted.count(Calculator._EQU) != 1:
-                    raise ValueError("Not a valid equation: must have exactly 1 equals sign")
-                if splitted.count(Calculator._UNK) != 1:
-                    splitted.append(Calculator._UNK)
-                    # raise ValueError("Not a valid equation: must have exactly 1 unknown sign")
-
-                # Separate two sides
-                left_side = []
-                right_side = []
-                is_left = True
-                for i in splitted:
-                    if i == Calculator._EQU:
-                        is_left = False
-                        continue
-                    if is_left:
-                        left_side.append(i)
-                    else:
-                        right_side.append(i)
-
-                # Check which side contains the unknown sign
-                if Calculator._UNK in left_side:
-                    right_result = self._eval_expr(right_side)
-                    return self.cvt_to_str(self._eval_unk_expr_eq_num(left_side, right_result))
-                elif Calculator._UNK in right_side:
-                    left_result = self._eval_expr(left_side)
-                    return self.cvt_to_str(self._eval_unk_expr_eq_num(right_side, left_result))
-                else:
-                    raise ValueError("No valid equation found")
         except BaseException as arg:
             if not ignore_error:
                 raise arg
             return None
 
+    def solve_many(self, problems:list):
+        """Solves many problems at once, identical problems are solved only once.
+        Comparisons of two numbers and additions or subtractions of two numbers take a fast path.
+
+        :param problems: The problem strings;
+        :returns: A tuple of the answer list and the error code list, in the same order as the problems,
+            where the answer is `None` if failed and the error code is `None` if succeeded;
+        :rtype: tuple;
+        """
+        solved = {}
+        answers = []
+        codes = []
+        for p in problems:
+            result = solved.get(p, None)
+            if result is None:
+                result = self._solve_fast(p) if p else None
+                if result is None:
+                    try:
+                        result = (self.solve(p), None)
+                    except CalculatorError as arg:
+                        result = (None, arg.code)
+                solved[p] = result
+            answers.append(result[0])
+            codes.append(result[1])
+        return answers, codes
+
+    @staticmethod
+    def _solve_fast(problem:str):
+        m = Calculator._FAST_COMPARISON.fullmatch(problem)
+        if m:
+            a, b = int(m.group(1)), int(m.group(2))
+            return ('>' if a > b else '<' if a < b else '=', None)
+        m = Calculator._FAST_ADD_MNS.fullmatch(problem)
+        if m:
+            a, b = int(m.group(1)), int(m.group(3))
+            return (str(a + b if m.group(2) == Calculator._ADD else a - b), None)
+        return None
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def tokenize(problem:str):
+        """Splits the problem string into numbers and symbols, which is cached by the problem string.
+        Within a run of consecutive symbols, the repeated ones are dropped.
+
+        :param problem: The problem string;
+        :returns: The tokens, numbers are `int` and symbols are `str`;
+        :rtype: tuple;
+        """
+        tokens = []
+        num_start = None
+        run = ""
+        for idx, i in enumerate(problem):
+            if '0' <= i <= '9':
+                if num_start is None:
+                    num_start = idx
+                run = ""
+                continue
+            if num_start is not None:
+                tokens.append(int(problem[num_start:idx]))
+                num_start = None
+            if i not in Calculator._SYMBOLS:
+                raise CalculatorError(CalculatorError.UNKNOWN_TOKEN, f"Unknown token '{i}'")
+            if i not in run:
+                tokens.append(i)
+                run += i
+        if num_start is not None:
+            tokens.append(int(problem[num_start:]))
+        return tuple(tokens)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def compile(tokens:tuple):
+        """Compiles the tokens into a program, which is cached by the token sequence.
+
+        :param tokens: The tokens returned by `tokenize`;
+        :returns: A tuple `(kind, left_tree, right_tree)`, where `kind` is the equals sign for equations
+            and the unknown sign for comparisons;
+        :rtype: tuple;
+        """
+        if Calculator._EQU not in tokens:
+            unknowns = tokens.count(Calculator._UNK)
+            if unknowns == 0:
+                raise CalculatorError(CalculatorError.SYNTAX, "Not a comparison problem: no unknown sign found")
+            elif unknowns > 1:
+                raise CalculatorError(CalculatorError.AMBIGUOUS, "Not a comparison problem: must have exactly 1 unknown sign")
+            idx = tokens.index(Calculator._UNK)
+            left, right = tokens[:idx], tokens[idx + 1:]
+            if not left or not right:
+                raise CalculatorError(CalculatorError.SYNTAX, "Not a comparison problem: comparison objects are missing")
+            return (Calculator._UNK, Calculator._parse(left), Calculator._parse(right))
+        else:
+            if tokens.count(Calculator._EQU) != 1:
+                raise CalculatorError(CalculatorError.SYNTAX, "Not a valid equation: must have exactly 1 equals sign")
+            unknowns = tokens.count(Calculator._UNK)
+            if unknowns == 0:
+                # Regard the missing unknown sign as the right side
+                tokens = tokens + (Calculator._UNK,)
+            elif unknowns > 1:
+                raise CalculatorError(CalculatorError.AMBIGUOUS, "Not a valid equation: must have exactly 1 unknown sign")
+            idx = tokens.index(Calculator._EQU)
+            return (Calculator._EQU, Calculator._parse(tokens[:idx]), Calculator._parse(tokens[idx + 1:]))
+
+    @staticmethod
+    def _parse(tokens:tuple):
+        # Shunting-yard parsing into an expression tree
+        operands = []
+        operators = []
+        def _reduce():
+            right = operands.pop()
+            left = operands.pop()
+            operands.append((operators.pop(), left, right))
+        expect_operand = True
+        for t in tokens:
+            if expect_operand:
+                if isinstance(t, int):
+                    operands.append((Calculator._N_NUM, t))
+                elif t == Calculator._UNK:
+                    operands.append((Calculator._N_UNK,))
+                else:
+                    raise CalculatorError(CalculatorError.SYNTAX, f"Not a valid expression: unexpected operator '{t}'")
+            else:
+                if t not in Calculator._OPERS:
+                    raise CalculatorError(CalculatorError.SYNTAX, f"Not a valid expression: unexpected token '{t}'")
+                while operators and Calculator._PRECEDENCE[operators[-1]] >= Calculator._PRECEDENCE[t]:
+                    _reduce()
+                operators.append(t)
+            expect_operand = not expect_operand
+        if expect_operand:
+            raise CalculatorError(CalculatorError.SYNTAX, "Not a valid expression: missing operand")
+        while operators:
+            _reduce()
+        return operands[0]
+
     @staticmethod
-    def cvt_to_str(num_or_str:"str|int|float", forbid_float:bool=False):
+    def cvt_to_str(num_or_str:"str|int|float|Fraction", forbid_float:bool=False):
         if isinstance(num_or_str, str):
             return num_or_str
         elif isinstance(num_or_str, int):
             return str(num_or_str)
+        elif isinstance(num_or_str, Fraction):
+            if num_or_str.denominator == 1:
+                return str(num_or_str.numerator)
+            elif forbid_float:
+                raise ValueError("No float support")
+            else:
+                return str(float(num_or_str))
         elif isinstance(num_or_str, float):
             if int(num_or_str) == num_or_str:
                 return str(int(num_or_str))
@@ -106,47 +220,84 @@ class Calculator:
         else:
             raise TypeError("Not a number or str")
 
-    def _eval_unk_expr_eq_num(self, unk_expr:list, eq_num:float):
-        if len(unk_expr) == 1:
-            return eq_num
-        elif len(unk_expr) == 3:
-            operator = unk_expr[1]
-            if unk_expr[0] == Calculator._UNK:
-                number = unk_expr[2]
+    @staticmethod
+    def _has_unknown(node:tuple):
+        if node[0] == Calculator._N_UNK:
+            return True
+        if node[0] == Calculator._N_NUM:
+            return False
+        return Calculator._has_unknown(node[1]) or Calculator._has_unknown(node[2])
+
+    def _solve_equation(self, left:tuple, right:tuple):
+        if Calculator._has_unknown(left):
+            return self._eval_unk_expr_eq_num(left, self._eval_expr(right))
+        else:
+            return self._eval_unk_expr_eq_num(right, self._eval_expr(left))
+
+    def _eval_unk_expr_eq_num(self, unk_expr:tuple, eq_num:"int|Fraction"):
+        # Invert the operations from the root down to the unknown sign
+        node = unk_expr
+        while node[0] != Calculator._N_UNK:
+            operator, left, right = node
+            if Calculator._has_unknown(left):
+                number = self._eval_expr(right)
                 if operator == Calculator._ADD:
-                    return float(eq_num - number)
+                    eq_num = eq_num - number
                 elif operator == Calculator._MNS:
-                    return float(eq_num + number)
+                    eq_num = eq_num + number
                 elif operator == Calculator._TMS:
-                    return float(eq_num / number)
-                elif operator ==  Calculator._DVD:
-                    return float(eq_num * number)
+                    if number == 0:
+                        Calculator._raise_degenerate(eq_num == 0, "unknown is multiplied by zero")
+                    eq_num = Fraction(eq_num) / number
+                elif operator == Calculator._DVD:
+                    if number == 0:
+                        raise CalculatorError(CalculatorError.DIVISION_BY_ZERO, "Division by zero")
+                    eq_num = eq_num * number
+                node = left
             else:
-                number = unk_expr[0]
+                number = self._eval_expr(left)
                 if operator == Calculator._ADD:
-                    return float(eq_num - number)
+                    eq_num = eq_num - number
                 elif operator == Calculator._MNS:
-                    return float(number - eq_num)
+                    eq_num = number - eq_num
                 elif operator == Calculator._TMS:
-                    return float(eq_num / number)
-                elif operator ==  Calculator._DVD:
-                    return float(number / eq_num)
-        raise ValueError("Cannot solve this equation yet")
-
-    def _eval_expr(self, expr:list):
-        total = expr[0]
-        i = 1 # First operation
-        while i < len(expr):
-            operator = expr[i]
-            next_value = expr[i + 1]
-
-            if operator == Calculator._ADD:
-                total += next_value
-            elif operator == Calculator._MNS:
-                total -= next_value
-            elif operator == Calculator._TMS:
-                total *= next_value
-            elif operator == Calculator._DVD:
-                total /= next_value
-            i += 2 # Move to the next operation
-        return total
+                    if number == 0:
+                        Calculator._raise_degenerate(eq_num == 0, "unknown is multiplied by zero")
+                    eq_num = Fraction(eq_num) / number
+                elif operator == Calculator._DVD:
+                    if eq_num == 0:
+                        Calculator._raise_degenerate(number == 0, "quotient of unknown divisor is zero")
+                    eq_num = Fraction(number) / eq_num
+                node = right
+        return Calculator._normalize(eq_num)
+
+    def _eval_expr(self, expr:tuple):
+        kind = expr[0]
+        if kind == Calculator._N_NUM:
+            return expr[1]
+        if kind == Calculator._N_UNK:
+            raise CalculatorError(CalculatorError.AMBIGUOUS, "Cannot evaluate an expression with unknown sign")
+        left = self._eval_expr(expr[1])
+        right = self._eval_expr(expr[2])
+        if kind == Calculator._ADD:
+            return left + right
+        elif kind == Calculator._MNS:
+            return left - right
+        elif kind == Calculator._TMS:
+            return left * right
+        else:
+            if right == 0:
+                raise CalculatorError(CalculatorError.DIVISION_BY_ZERO, "Division by zero")
+            return Calculator._normalize(Fraction(left) / right)
+
+    @staticmethod
+    def _raise_degenerate(any_solution:bool, reason:str):
+        if any_solution:
+            raise CalculatorError(CalculatorError.AMBIGUOUS, f"Cannot solve this equation: {reason}, any number is a solution")
+        raise CalculatorError(CalculatorError.UNSOLVABLE, f"Cannot solve this equation: {reason}, no number is a solution")
+
+    @staticmethod
+    def _normalize(value:"int|Fraction"):
+        if isinstance(value, Fraction) and value.denominator == 1:
+            return value.numerator
+        return value
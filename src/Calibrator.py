@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import cv2
+import numpy as np
+from .CaptureBackend import CaptureBackend
+from .PlayerAgent import PlayerAgent
+
+
+class RegionCalibrator:
+    """Locates the game viewport on the screen by the layout of its anchors.
+
+    The anchors are the question cards (`PlayerAgent.REGION_THIS_QUESTION` and `PlayerAgent.REGION_NEXT_QUESTION`)
+    and the answering pad (`PlayerAgent.REGION_ANSWERING`), which are brighter than the rest of the viewport,
+    and the current question card contains dark glyphs. A candidate viewport of the given aspect ratio is scored
+    by the contrast between its anchors and the rest of it, relative to the deviation of the rest, so that a candidate
+    covering some screen outside the uniform game background is penalized. A ring of `RING` (relative to the
+    viewport width) around each anchor is left out of both sides, since the cards are a bit larger than the anchors.
+    The score of a candidate is computed in constant time from integral images.
+    The search is coarse-to-fine: all candidates are scored on a screenshot downsampled by `SCALE`, then the
+    best one is refined pixel by pixel at the full resolution.
+    """
+
+    SCALE = 8
+    INK_THRESHOLD = 64
+    MIN_SCORE = 1.0
+    STD_FLOOR = 16
+    MIN_HEIGHT = 0.3 # of the searched area
+    RING = 0.02
+    ANCHORS = (PlayerAgent.REGION_THIS_QUESTION, PlayerAgent.REGION_NEXT_QUESTION, PlayerAgent.REGION_ANSWERING)
+
+    def __init__(self, aspect:float):
+        """Initializes the calibrator.
+
+        :param aspect: The aspect ratio (width / height) of the viewport;
+        """
+        self.aspect = aspect
+
+    def score(self, image:np.ndarray):
+        """Scores the given viewport capture, which is cheap enough to verify the current region periodically.
+
+        :param image: The single-channel capture of the viewport;
+        :returns: The contrast between the anchors and the rest of the viewport, relative to the deviation of the rest;
+        :rtype: float;
+        """
+        if image.size == 0:
+            return 0.0
+        h, w = image.shape[:2]
+        image = cv2.resize(image, (max(1, w // RegionCalibrator.SCALE), max(1, h // RegionCalibrator.SCALE)),
+                           interpolation=cv2.INTER_AREA)
+        integrals = cv2.integral2(image, sdepth=cv2.CV_64F)
+        h, w = image.shape
+        return float(self._contrast(integrals, w, h, np.zeros((1, 1), dtype=np.intp), np.zeros((1, 1), dtype=np.intp))[0, 0])
+
+    def verify(self, image:np.ndarray):
+        """Checks whether the given capture of the current region still shows the game viewport.
+
+        :param image: The single-channel capture of the viewport;
+        :rtype: bool;
+        """
+        return self.score(image) >= RegionCalibrator.MIN_SCORE
+
+    def locate(self, image:np.ndarray, origin:tuple=(0, 0)):
+        """Searches the given screenshot for the game viewport.
+
+        :param image: The single-channel screenshot;
+        :param origin: The screen coordinates of the top-left corner of the screenshot;
+        :returns: The located region in the format `((left, top), (right, bottom))`, `None` if not found;
+        :rtype: tuple|None;
+        """
+        s = RegionCalibrator.SCALE
+        h, w = image.shape[:2]
+        if h < s * 4 or w < s * 4:
+            return None
+        ink = (image < RegionCalibrator.INK_THRESHOLD).view(np.uint8)
+        small = cv2.resize(image, (w // s, h // s), interpolation=cv2.INTER_AREA)
+        small_ink = cv2.resize(ink.astype(np.float32), (w // s, h // s), interpolation=cv2.INTER_AREA)
+        max_h = min(small.shape[0], int(small.shape[1] / self.aspect))
+        coarse = self._search(small, small_ink, range(max(4, int(max_h * RegionCalibrator.MIN_HEIGHT)), max_h + 1))
+        if coarse is None:
+            return None
+        # Refines around the coarse result at the full resolution
+        x, y, cw, ch = (i * s for i in coarse[1:])
+        left, top = max(0, x - s * 2), max(0, y - s * 2)
+        right, bottom = min(w, x + cw + s * 2), min(h, y + ch + s * 2)
+        max_h = min(bottom - top, int((right - left) / self.aspect))
+        fine = self._search(image[top:bottom, left:right], ink[top:bottom, left:right],
+                            range(max(4, ch - s * 2), min(max_h, ch + s * 2) + 1))
+        if fine is None:
+            return None
+        _, x, y, cw, ch = fine
+        x, y = x + left + origin[0], y + top + origin[1]
+        return ((x, y), (x + cw, y + ch))
+
+    def locate_on(self, capture:CaptureBackend, near:tuple=None):
+        """Grabs the screen and searches it for the game viewport.
+
+        :param capture: The capture backend;
+        :param near: The region in the format `((left, top), (right, bottom))`, the search is limited to
+                     its neighbourhood of the same size if given, otherwise the whole screen is searched;
+        :returns: The located region in the format `((left, top), (right, bottom))`, `None` if not found;
+        :rtype: tuple|None;
+        """
+        if near:
+            (l, t), (r, b) = near
+            l, t, r, b = l - (r - l) // 2, t - (b - t) // 2, r + (r - l) // 2, b + (b - t) // 2
+        else:
+            l, t, r, b = capture.bounds
+        bl, bt, _, _ = capture.bounds
+        l, t = max(l, bl), max(t, bt)
+        # The grab reuses its buffer, while the search only reads it
+        return self.locate(capture.grab(l, t, r, b, grayscale=True), (l, t))
+
+    def _search(self, image:np.ndarray, ink:np.ndarray, heights:range):
+        integrals = cv2.integral2(image, sdepth=cv2.CV_64F)
+        ink_integral = cv2.integral(ink, sdepth=cv2.CV_64F)
+        h, w = image.shape[:2]
+        best = None
+        for ch in heights:
+            cw = int(round(ch * self.aspect))
+            if cw < 4 or cw > w or ch > h:
+                continue
+            ys, xs = np.mgrid[0:h - ch + 1, 0:w - cw + 1]
+            contrast = self._contrast(integrals, cw, ch, xs, ys)
+            # The question card must contain some glyphs, at least one downsampled pixel of ink
+            (qx0, qy0), (qx1, qy1) = RegionCalibrator._box(RegionCalibrator.ANCHORS[0], cw, ch)
+            glyphs = RegionCalibrator._box_sum(ink_integral, xs + qx0, ys + qy0, xs + qx1, ys + qy1)
+            contrast[glyphs < 1] = -np.inf
+            idx = np.unravel_index(int(np.argmax(contrast)), contrast.shape)
+            value = float(contrast[idx])
+            if value >= RegionCalibrator.MIN_SCORE and (best is None or value > best[0]):
+                best = (value, int(xs[idx]), int(ys[idx]), cw, ch)
+        return best
+
+    def _contrast(self, integrals:tuple, w:int, h:int, xs:np.ndarray, ys:np.ndarray):
+        integral, sq_integral = integrals
+        rest = RegionCalibrator._box_sum(integral, xs, ys, xs + w, ys + h)
+        sq_rest = RegionCalibrator._box_sum(sq_integral, xs, ys, xs + w, ys + h)
+        rest_area = w * h
+        anchor_mean = None
+        ring = int(w * RegionCalibrator.RING)
+        for anchor in RegionCalibrator.ANCHORS:
+            (x0, y0), (x1, y1) = RegionCalibrator._box(anchor, w, h)
+            # The inner box is averaged as the anchor, and the outer box is excluded from the rest
+            ix0, iy0, ix1, iy1 = x0 + ring, y0 + ring, max(x0 + ring + 1, x1 - ring), max(y0 + ring + 1, y1 - ring)
+            ox0, oy0, ox1, oy1 = max(0, x0 - ring), max(0, y0 - ring), min(w, x1 + ring), min(h, y1 + ring)
+            area = (ix1 - ix0) * (iy1 - iy0)
+            s = RegionCalibrator._box_sum(integral, xs + ix0, ys + iy0, xs + ix1, ys + iy1)
+            anchor_mean = s / area if anchor_mean is None else np.minimum(anchor_mean, s / area)
+            rest = rest - RegionCalibrator._box_sum(integral, xs + ox0, ys + oy0, xs + ox1, ys + oy1)
+            sq_rest = sq_rest - RegionCalibrator._box_sum(sq_integral, xs + ox0, ys + oy0, xs + ox1, ys + oy1)
+            rest_area -= (ox1 - ox0) * (oy1 - oy0)
+        rest_area = max(1, rest_area)
+        rest_mean = rest / rest_area
+        rest_std = np.sqrt(np.maximum(sq_rest / rest_area - rest_mean * rest_mean, 0))
+        return (anchor_mean - rest_mean) / (rest_std + RegionCalibrator.STD_FLOOR)
+
+    @staticmethod
+    def _box(anchor:tuple, w:int, h:int):
+        (rl, rt), (rr, rb) = anchor
+        return (int(rl * w), int(rt * h)), (int(rr * w), int(rb * h))
+
+    @staticmethod
+    def _box_sum(integral:np.ndarray, x0:np.ndarray, y0:np.ndarray, x1:np.ndarray, y1:np.ndarray):
+        return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import cv2
+import os
+import threading
+import numpy as np
+from .utils.Logger import Logger
+
+
+class CaptureBackend:
+    """Base class of screen capture backends.
+
+    A backend grabs only the requested screen rectangle and writes the pixels into a reusable NumPy buffer.
+    The returned array is owned by the backend and will be overwritten by the next grab of the same shape,
+    so callers that keep a frame across grabs must copy it.
+    """
+
+    def __init__(self):
+        self._buffers:"dict[tuple,np.ndarray]" = {}
+
+    @property
+    def bounds(self):
+        """The capturable area, in the format `(left, top, right, bottom)`.
+
+        :rtype: tuple;
+        """
+        raise NotImplementedError()
+
+    @property
+    def screen_size(self):
+        """The size of the capturable area, in the format `(width, height)`.
+
+        :rtype: tuple;
+        """
+        l, t, r, b = self.bounds
+        return (r - l, b - t)
+
+    def grab(self, left:int, top:int, right:int, bottom:int, grayscale:bool=False):
+        """Grabs the given screen rectangle. The rectangle will be clipped by the capturable area.
+
+        :param left: The left edge in screen coordinates;
+        :param top: The top edge in screen coordinates;
+        :param right: The right edge (exclusive) in screen coordinates;
+        :param bottom: The bottom edge (exclusive) in screen coordinates;
+        :param grayscale: Whether to return a single-channel image instead of a BGR image;
+        :returns: The image of the rectangle, which is a reused buffer;
+        :rtype: np.ndarray;
+        """
+        bl, bt, br, bb = self.bounds
+        left, top = max(int(left), bl), max(int(top), bt)
+        right, bottom = max(min(int(right), br), left), max(min(int(bottom), bb), top)
+        dst = self._get_buffer((bottom - top, right - left) if grayscale else (bottom - top, right - left, 3))
+        if dst.size == 0:
+            return dst
+        return self._grab(left, top, right - left, bottom - top, dst)
+
+    def close(self):
+        """Releases the resources held by the backend."""
+        self._buffers.clear()
+
+    def _grab(self, left:int, top:int, width:int, height:int, dst:np.ndarray):
+        raise NotImplementedError()
+
+    def _get_buffer(self, shape:tuple):
+        buffer = self._buffers.get(shape, None)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=np.uint8)
+            self._buffers[shape] = buffer
+        return buffer
+
+
+class MSSCaptureBackend(CaptureBackend):
+    """Capture backend based on MSS, which uses XShm/XGetImage on Linux and BitBlt on Windows
+    to grab only the requested rectangle without a PIL round-trip.
+    """
+
+    def __init__(self):
+        super().__init__()
+        import mss
+        self._mss = mss
+        self._local = threading.local()
+        self._scts = []
+        self._scts_lock = threading.Lock()
+        self._bounds = None
+
+    def _get_sct(self):
+        # MSS instances are bound to the thread that created them
+        sct = getattr(self._local, 'sct', None)
+        if sct is None:
+            sct = self._mss.mss()
+            self._local.sct = sct
+            with self._scts_lock:
+                self._scts.append(sct)
+        return sct
+
+    @property
+    def bounds(self):
+        if self._bounds is None:
+            m = self._get_sct().monitors[0]
+            self._bounds = (m['left'], m['top'], m['left'] + m['width'], m['top'] + m['height'])
+        return self._bounds
+
+    def _grab(self, left:int, top:int, width:int, height:int, dst:np.ndarray):
+        shot = self._get_sct().grab({'left': left, 'top': top, 'width': width, 'height': height})
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(height, width, 4)
+        cv2.cvtColor(bgra, cv2.COLOR_BGRA2GRAY if dst.ndim == 2 else cv2.COLOR_BGRA2BGR, dst=dst)
+        return dst
+
+    def close(self):
+        # The instances created by the other threads are closed as well, the threads must not grab any more
+        with self._scts_lock:
+            scts, self._scts = self._scts, []
+        for sct in scts:
+            sct.close()
+        self._local = threading.local()
+        super().close()
+
+
+class PyAutoGUICaptureBackend(CaptureBackend):
+    """Capture backend based on PyAutoGUI, used as a fallback when MSS is unavailable.
+    Only the requested rectangle is grabbed, but the pixels still pass through a PIL image.
+    """
+
+    def __init__(self):
+        super().__init__()
+        import pyautogui
+        self._pag = pyautogui
+
+    @property
+    def bounds(self):
+        w, h = self._pag.size()
+        return (0, 0, w, h)
+
+    def _grab(self, left:int, top:int, width:int, height:int, dst:np.ndarray):
+        image = self._pag.screenshot(region=(left, top, width, height))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2GRAY if dst.ndim == 2 else cv2.COLOR_RGB2BGR, dst=dst)
+        return dst
+
+
+class FakeCaptureBackend(CaptureBackend):
+    """In-memory capture backend that replays pre-recorded frames, used for headless tests and benchmarks.
+    Every frame is regarded as a screenshot whose top-left corner is placed at the given origin.
+    """
+
+    _IMAGE_EXT = ('.png', '.jpg')
+
+    def __init__(self, frames:list, origin:tuple=(0, 0), loop:bool=False):
+        super().__init__()
+        self._frames = [FakeCaptureBackend._load(f) if isinstance(f, str) else f for f in frames]
+        if not self._frames:
+            raise ValueError("At least one frame is required")
+        self._origin = (int(origin[0]), int(origin[1]))
+        self._loop = loop
+        self._index = 0
+
+    @staticmethod
+    def _load(file_path:str):
+        image = cv2.imread(file_path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Cannot read the frame image '{file_path}'")
+        return image
+
+    @staticmethod
+    def from_dir(dir_path:str, origin:tuple=(0, 0), loop:bool=False):
+        """Creates a backend that replays the image files in the given directory, sorted by file name.
+
+        :param dir_path: The path to the directory;
+        :param origin: The screen coordinates of the top-left corner of each frame;
+        :param loop: Whether to restart from the first frame after the last one;
+        :returns: The backend instance;
+        :rtype: FakeCaptureBackend;
+        """
+        files = [os.path.join(dir_path, i) for i in sorted(os.listdir(dir_path))
+                 if os.path.splitext(i)[1].lower() in FakeCaptureBackend._IMAGE_EXT]
+        return FakeCaptureBackend(files, origin, loop)
+
+    @property
+    def frame_index(self):
+        return self._index
+
+    @property
+    def frame_count(self):
+        return len(self._frames)
+
+    @property
+    def bounds(self):
+        h, w = self._frames[self._index].shape[:2]
+        return (self._origin[0], self._origin[1], self._origin[0] + w, self._origin[1] + h)
+
+    def next_frame(self):
+        """Switches to the next frame.
+
+        :returns: `False` if there are no more frames, otherwise `True`;
+        :rtype: bool;
+        """
+        if self._index + 1 < len(self._frames):
+            self._index += 1
+            return True
+        elif self._loop:
+            self._index = 0
+            return True
+        return False
+
+    def seek(self, index:int):
+        """Switches to the frame of the given index.
+
+        :param index: The index of the frame;
+        :rtype: None;
+        """
+        if not 0 <= index < len(self._frames):
+            raise IndexError("Frame index out of range")
+        self._index = index
+
+    def _grab(self, left:int, top:int, width:int, height:int, dst:np.ndarray):
+        x, y = left - self._origin[0], top - self._origin[1]
+        frame = self._frames[self._index][y:y + height, x:x + width]
+        if dst.ndim == 2:
+            if frame.ndim == 3:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+            else:
+                np.copyto(dst, frame)
+        else:
+            if frame.ndim == 2:
+                cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=dst)
+            else:
+                np.copyto(dst, frame)
+        return dst
+
+
+class SharedCaptureBackend(CaptureBackend):
+    """Capture backend that serves several consumers from one capture of the bounding box of their regions.
+
+    The bounding box is grabbed only by `refresh`, which the owner calls once per capture tick before the
+    consumers grab their regions, so all of them share the same capture. A grab returns a view of the shared
+    capture, which is never overwritten. A rectangle outside the bounding box, or a grab before the first refresh,
+    is served by the wrapped backend directly.
+    """
+
+    def __init__(self, backend:CaptureBackend, regions:list):
+        super().__init__()
+        self._backend = backend
+        self._rect:tuple = None
+        self._frames:"dict[bool,np.ndarray]" = {}
+        self._lock = threading.Lock()
+        self.grabs = 0
+        self.requests = 0
+        self.set_regions(regions)
+
+    @property
+    def bounds(self):
+        return self._backend.bounds
+
+    def set_regions(self, regions:list):
+        """Updates the regions of the consumers, which takes effect from the next refresh.
+
+        :param regions: The regions in the format `[((left, top), (right, bottom)), ...]`;
+        :rtype: None;
+        """
+        rect = (min(int(lt[0]) for lt, _ in regions), min(int(lt[1]) for lt, _ in regions),
+                max(int(rb[0]) for _, rb in regions), max(int(rb[1]) for _, rb in regions))
+        with self._lock:
+            if rect != self._rect:
+                self._rect = rect
+                self._frames.clear()
+
+    def refresh(self, grayscale:bool=False):
+        """Grabs the bounding box of the regions, which will be shared by the following grabs.
+
+        :param grayscale: Whether to capture a single-channel image;
+        :rtype: None;
+        """
+        with self._lock:
+            # The wrapped backend reuses its buffer, so the shared capture must be a copy
+            self._frames[grayscale] = self._backend.grab(*self._rect, grayscale).copy()
+            self.grabs += 1
+
+    def grab(self, left:int, top:int, right:int, bottom:int, grayscale:bool=False):
+        with self._lock:
+            self.requests += 1
+            rl, rt, rr, rb = self._rect
+            frame = self._frames.get(grayscale, None)
+            if frame is None or not (rl <= left and rt <= top and right <= rr and bottom <= rb):
+                return self._backend.grab(left, top, right, bottom, grayscale).copy()
+        bl, bt = max(rl, self.bounds[0]), max(rt, self.bounds[1])
+        return frame[max(int(top) - bt, 0):max(int(bottom) - bt, 0), max(int(left) - bl, 0):max(int(right) - bl, 0)]
+
+    def close(self):
+        self._frames.clear()
+        self._backend.close()
+        super().close()
+
+    def stats(self):
+        return {
+            'grabs': self.grabs,
+            'requests': self.requests,
+            'requests_per_grab': self.requests / self.grabs if self.grabs else None
+        }
+
+
+def create_capture_backend(name:str="auto"):
+    """Creates a screen capture backend by name.
+
+    :param name: `"mss"`, `"pyautogui"` or `"auto"` (prefers MSS and falls back to PyAutoGUI);
+    :returns: The backend instance;
+    :rtype: CaptureBackend;
+    """
+    if name in ("auto", "mss"):
+        try:
+            return MSSCaptureBackend()
+        except ImportError as arg:
+            if name == "mss":
+                raise arg
+            Logger.info("CaptureBackend: MSS is unavailable, falling back to PyAutoGUI")
+    if name in ("auto", "pyautogui"):
+        return PyAutoGUICaptureBackend()
+    raise ValueError(f"Unknown capture backend '{name}'")
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable
+from .Pipeline import MultiSessionPipeline, SolvePipeline
+from .utils.AnalyUtils import TestRT
+from .utils.Logger import Logger
+
+
+class StatusSubscription:
+    """Throttled view of the engine status.
+
+    The engine offers every status update, but only the latest one is kept and it is delivered at most
+    once per `interval` seconds, so a slow subscriber never holds back the engine. The final status
+    (whose `running` field is `False`) is always delivered.
+    """
+
+    def __init__(self, interval:float, callback:Callable=None):
+        self.interval = interval
+        self._callback = callback
+        self._latest:dict = None
+        self._delivered_at = 0
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def poll(self):
+        """Takes the latest undelivered status without blocking.
+
+        :returns: The status dict, `None` if there is nothing new;
+        :rtype: dict|None;
+        """
+        with self._lock:
+            status, self._latest = self._latest, None
+            self._event.clear()
+            return status
+
+    def wait(self, timeout:float=None):
+        """Blocks until a new status is delivered or the timeout expires, then takes it.
+
+        :param timeout: The maximum seconds to wait, `None` to wait forever;
+        :returns: The status dict, `None` if there is nothing new;
+        :rtype: dict|None;
+        """
+        self._event.wait(timeout)
+        return self.poll()
+
+    def _due(self, now:float):
+        return now - self._delivered_at >= self.interval
+
+    def _offer(self, status:dict):
+        self._delivered_at = time.monotonic()
+        if self._callback:
+            self._callback(status)
+        with self._lock:
+            self._latest = status
+            self._event.set()
+
+
+class Engine:
+    """Runs a solve pipeline on its own thread, independently of any UI.
+
+    The engine is controlled only by the control messages sent through `send`, and it is observed through
+    the throttled status subscriptions created by `subscribe`. Each status is a dict containing the current
+    question and answer, the answered count, the questions per minute, the per-stage latency, the count of
+    game region changes, which are made by `CTRL_CALIBRATE` or by the drift tracking of the pipeline, and the count
+    of successful calibrations requested by `CTRL_CALIBRATE`.
+    """
+
+    CTRL_PAUSE = 'pause'
+    CTRL_RESUME = 'resume'
+    CTRL_STOP = 'stop'
+    CTRL_CALIBRATE = 'calibrate'
+    RATE_WINDOW = 60
+    RATE_MIN_WINDOW = 5
+
+    def __init__(self, pipeline:"SolvePipeline|MultiSessionPipeline", tick:float=0.05):
+        self._pipeline = pipeline
+        self._tick = tick
+        self._control:"queue.Queue[str]" = queue.Queue()
+        self._subscriptions:"list[StatusSubscription]" = []
+        self._subscriptions_lock = threading.Lock()
+        self._thread:threading.Thread = None
+        self._stopped = threading.Event()
+        self._answers:"deque[float]" = deque()
+        self._started_at = None
+        self._status = {
+            'running': False,
+            'paused': False,
+            'question': None,
+            'answer': None,
+            'session': None,
+            'answered': 0,
+            'questions_per_min': 0.0,
+            'region_changes': 0,
+            'calibrations': 0,
+            'stages': {}
+        }
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    def start(self):
+        """Starts the pipeline and the engine thread.
+
+        :rtype: None;
+        """
+        self._started_at = time.monotonic()
+        self._status['running'] = True
+        self._pipeline.start()
+        self._thread = threading.Thread(name="Engine", target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, message:str):
+        """Sends a control message to the engine.
+
+        :param message: `CTRL_PAUSE`, `CTRL_RESUME`, `CTRL_STOP` or `CTRL_CALIBRATE`;
+        :rtype: None;
+        """
+        if message not in (Engine.CTRL_PAUSE, Engine.CTRL_RESUME, Engine.CTRL_STOP, Engine.CTRL_CALIBRATE):
+            raise ValueError(f"Unknown control message '{message}'")
+        self._control.put(message)
+
+    def subscribe(self, interval:float=0.25, callback:Callable=None):
+        """Subscribes to the status of the engine.
+
+        :param interval: The minimum seconds between two deliveries;
+        :param callback: The callable invoked with each delivered status on the engine thread;
+        :returns: The subscription;
+        :rtype: StatusSubscription;
+        """
+        subscription = StatusSubscription(interval, callback)
+        with self._subscriptions_lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription:StatusSubscription):
+        with self._subscriptions_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def wait(self, timeout:float=None):
+        """Blocks until the engine stops or the timeout expires.
+
+        :param timeout: The maximum seconds to wait, `None` to wait forever;
+        :returns: `True` if the engine stopped;
+        :rtype: bool;
+        """
+        return self._stopped.wait(timeout)
+
+    def stop(self, timeout:float=None):
+        """Stops the engine and waits for it.
+
+        :param timeout: The maximum seconds to wait, `None` to wait forever;
+        :rtype: None;
+        """
+        if self._thread and self._thread.is_alive():
+            self.send(Engine.CTRL_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                message = self._control.get(timeout=self._tick)
+            except queue.Empty:
+                message = None
+            if message == Engine.CTRL_PAUSE:
+                self._pipeline.pause()
+            elif message == Engine.CTRL_RESUME:
+                self._pipeline.resume()
+            elif message == Engine.CTRL_STOP:
+                running = False
+            elif message == Engine.CTRL_CALIBRATE:
+                if self._pipeline.calibrate():
+                    self._status['calibrations'] += 1
+            for event in self._pipeline.poll_status():
+                if event['type'] == 'answer':
+                    self._answers.append(time.monotonic())
+                    self._status['question'] = event['question']
+                    self._status['answer'] = event['answer']
+                    self._status['session'] = event.get('session', None)
+                    self._status['answered'] += 1
+                elif event['type'] == 'region':
+                    self._status['region_changes'] += 1
+                elif event['type'] == 'exit':
+                    Logger.info("Engine: The pipeline exited.")
+                    running = False
+            if not running:
+                self._pipeline.stop()
+            self._publish(running)
+        self._stopped.set()
+
+    def _publish(self, running:bool):
+        now = time.monotonic()
+        while self._answers and self._answers[0] < now - Engine.RATE_WINDOW:
+            self._answers.popleft()
+        # Not shorter than a few seconds, otherwise the first answers give a meaningless spike
+        window = min(Engine.RATE_WINDOW, max(Engine.RATE_MIN_WINDOW, now - self._started_at))
+        self._status['running'] = running
+        self._status['paused'] = self._pipeline.paused
+        self._status['questions_per_min'] = len(self._answers) * 60 / window
+        with self._subscriptions_lock:
+            subscriptions = [s for s in self._subscriptions if not running or s._due(now)]
+        if not subscriptions:
+            return
+        status = dict(self._status)
+        status['stages'] = {k: v.get('p50_ms', None) for k, v in TestRT.snapshot().items() if k.endswith('Stage')}
+        for s in subscriptions:
+            try:
+                s._offer(status)
+            except Exception as arg:
+                Logger.warn(f"Engine: Status subscriber failed, cause: {arg}")
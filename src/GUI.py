@@ -14,6 +14,7 @@ class IndicatorWindow:
 
         self.paused = False
         self.on_click_setting = None
+        self.on_toggle_pause = None
         self.on_loop = None
         self.interval = 0
 
@@ -35,7 +36,7 @@ class IndicatorWindow:
         self._loop()
 
     def _loop(self):
-        if not self.paused and self.on_loop != None:
+        if self.on_loop != None:
             self.on_loop()
         self.root.after(int(self.interval * 1000), self._loop)
 
@@ -46,10 +47,15 @@ class IndicatorWindow:
     def _toggle_pause(self):
         self.paused = not self.paused
         self.pause_button.config(text="继续" if self.paused else "暂停")
+        if self.on_toggle_pause:
+            self.on_toggle_pause(self.paused)
 
     def set_click_setting_trigger(self, callback:Callable):
         self.on_click_setting = callback
 
+    def set_toggle_pause_trigger(self, callback:Callable):
+        self.on_toggle_pause = callback
+
     def set_loop_trigger(self, callback:Callable, interval:float):
         self.on_loop = callback
         self.interval = interval
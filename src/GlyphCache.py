@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import cv2
+import json
+import os.path as osp
+import threading
+import numpy as np
+from collections import OrderedDict
+from .utils.Logger import Logger
+
+
+class GlyphCache:
+    """Bounded LRU cache mapping glyph signatures to recognized labels.
+
+    The signature is a perceptual hash of the glyph: the glyph is binarized, resampled to a small fixed grid
+    and bit-packed, then prefixed with its quantized aspect ratio. Identical renders of a char always share
+    the same signature, so the template matching can be skipped for them.
+    """
+
+    GRID_SIZE = (16, 16) # (width, height)
+    BINARY_THRESHOLD = 128
+    __file_encoding = 'UTF-8'
+
+    def __init__(self, capacity:int=1024):
+        self._capacity = max(0, capacity)
+        self._data:"OrderedDict[bytes,tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def signature(image:cv2.typing.MatLike):
+        """Computes the perceptual signature of the given single-channel glyph image.
+
+        :param image: The glyph image;
+        :returns: The signature;
+        :rtype: bytes;
+        """
+        h, w = image.shape[:2]
+        binary = (image < GlyphCache.BINARY_THRESHOLD).astype(np.uint8)
+        grid = cv2.resize(binary, GlyphCache.GRID_SIZE, interpolation=cv2.INTER_NEAREST)
+        aspect = min(255, w * 16 // max(1, h))
+        return bytes((aspect,)) + np.packbits(grid).tobytes()
+
+    def get(self, key:bytes):
+        """Gets the cached value of the given signature.
+
+        :param key: The signature of the glyph;
+        :returns: A tuple of the label and the confidence, `None` if it was not cached;
+        :rtype: tuple|None;
+        """
+        with self._lock:
+            value = self._data.get(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key:bytes, label:str, confidence:float):
+        """Puts a recognition result into the cache. An empty label means the glyph was rejected.
+
+        :param key: The signature of the glyph;
+        :param label: The recognized label;
+        :param confidence: The matching confidence;
+        :rtype: None;
+        """
+        if self._capacity <= 0:
+            return
+        with self._lock:
+            self._data[key] = (label, confidence)
+            self._data.move_to_end(key)
+            while len(self._data) > self._capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Gets the counters of this cache.
+
+        :returns: A dict containing the size, capacity, hits, misses, evictions and hit rate;
+        :rtype: dict;
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'capacity': self._capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else None
+        }
+
+    def load(self, file_path:str, fingerprint:str=""):
+        """Loads the cache entries from file.
+        The file will be ignored if its fingerprint differs, which means the templates or the recognizer have changed.
+
+        :param file_path: The path to the cache file;
+        :param fingerprint: The fingerprint of the recognition results, see `Recognizer.fingerprint`;
+        :returns: The count of loaded entries;
+        :rtype: int;
+        """
+        if self._capacity <= 0 or not file_path or not osp.isfile(file_path):
+            return 0
+        try:
+            with open(file_path, 'r', encoding=GlyphCache.__file_encoding) as f:
+                loaded = json.load(f)
+            if loaded.get('fingerprint', None) != fingerprint:
+                Logger.info("GlyphCache: Templates or recognizer changed, discarded the cache file.")
+                return 0
+            keys = set()
+            for key, label, confidence in loaded.get('entries', [])[-self._capacity:]:
+                key = bytes.fromhex(key)
+                keys.add(key)
+                self.put(key, label, confidence)
+            # Duplicated keys are stored once, and the earlier entries may have been evicted
+            with self._lock:
+                count = sum(1 for k in keys if k in self._data)
+            Logger.info(f"GlyphCache: Loaded {count} entries.")
+            return count
+        except Exception as arg:
+            Logger.error(f"GlyphCache: Failed to load cache file, cause: {arg}")
+            return 0
+
+    def save(self, file_path:str, fingerprint:str=""):
+        """Saves the cache entries to file, from the least to the most recently used.
+
+        :param file_path: The path to the cache file;
+        :param fingerprint: The fingerprint of the recognition results, see `Recognizer.fingerprint`;
+        :rtype: None;
+        """
+        if not file_path:
+            return
+        try:
+            with self._lock:
+                entries = [[k.hex(), v[0], v[1]] for k, v in self._data.items()]
+            with open(file_path, 'w', encoding=GlyphCache.__file_encoding) as f:
+                json.dump({'fingerprint': fingerprint, 'entries': entries}, f)
+            Logger.info(f"GlyphCache: Saved {len(entries)} entries.")
+        except Exception as arg:
+            Logger.error(f"GlyphCache: Failed to save cache file, cause: {arg}")
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import threading
+import time
+from collections import deque
+from typing import Callable
+from .StrokeCompiler import StrokeCompiler
+from .utils.Logger import Logger
+
+
+class FailSafeException(Exception):
+    """Raised when the user moves the mouse to a screen corner to abort the automation,
+    equivalent to `pyautogui.FailSafeException`.
+    """
+
+
+class InputBackend:
+    """Base class of pointer input injection backends.
+
+    A backend replays the events compiled by `StrokeCompiler`. It sleeps `event_interval` seconds after every
+    event, unless it is a batched backend, which flushes a whole stroke at once and sleeps after each stroke.
+    The fail-safe is checked before every stroke.
+    """
+
+    BATCHED = False
+
+    def __init__(self, event_interval:float=0):
+        self.event_interval = event_interval
+
+    def play(self, events:tuple, is_cancelled:Callable=None):
+        """Replays the given events.
+
+        :param events: The events compiled by `StrokeCompiler`;
+        :param is_cancelled: The callable checked before every stroke, the playing stops if it returns `True`;
+        :returns: `False` if the playing was cancelled, otherwise `True`;
+        :rtype: bool;
+        """
+        for op, x, y in events:
+            if op == StrokeCompiler.EV_DOWN:
+                if is_cancelled and is_cancelled():
+                    return False
+                self.check_failsafe()
+                self._down(x, y)
+            elif op == StrokeCompiler.EV_MOVE:
+                self._move(x, y)
+            else:
+                self._up(x, y)
+                if self.BATCHED:
+                    self._flush()
+            if self.event_interval > 0 and (not self.BATCHED or op == StrokeCompiler.EV_UP):
+                time.sleep(self.event_interval)
+        return True
+
+    def check_failsafe(self):
+        """Raises `FailSafeException` if the fail-safe has been triggered by the user.
+
+        :rtype: None;
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def _down(self, x:int, y:int):
+        raise NotImplementedError()
+
+    def _move(self, x:int, y:int):
+        raise NotImplementedError()
+
+    def _up(self, x:int, y:int):
+        raise NotImplementedError()
+
+    def _flush(self):
+        pass
+
+
+class PyAutoGUIInputBackend(InputBackend):
+    """Input backend based on PyAutoGUI. Each event is sent separately,
+    and PyAutoGUI checks its fail-safe points on every event.
+    """
+
+    def __init__(self, event_interval:float=0.04):
+        super().__init__(event_interval)
+        import pyautogui
+        self._pag = pyautogui
+
+    def play(self, events:tuple, is_cancelled:Callable=None):
+        try:
+            return super().play(events, is_cancelled)
+        except self._pag.FailSafeException as arg:
+            raise FailSafeException(str(arg)) from arg
+
+    def _down(self, x:int, y:int):
+        self._pag.mouseDown(x, y, duration=0, _pause=False)
+
+    def _move(self, x:int, y:int):
+        self._pag.moveTo(x, y, duration=0, _pause=False)
+
+    def _up(self, x:int, y:int):
+        self._pag.mouseUp(_pause=False)
+
+
+class XTestInputBackend(InputBackend):
+    """Batched input backend based on the XTest extension of X11 (Linux only).
+    The events of a whole stroke are queued and sent to the X server in one flush.
+    The fail-safe points are the four screen corners, the same as PyAutoGUI.
+    """
+
+    BATCHED = True
+
+    def __init__(self, event_interval:float=0.01):
+        super().__init__(event_interval)
+        from Xlib import X, display
+        from Xlib.ext import xtest
+        self._X = X
+        self._xtest = xtest
+        self._display = display.Display()
+        if not self._display.has_extension('XTEST'):
+            raise ImportError("XTest extension is unavailable")
+        screen = self._display.screen()
+        w, h = screen.width_in_pixels, screen.height_in_pixels
+        self._root = screen.root
+        self._failsafe_points = ((0, 0), (0, h - 1), (w - 1, 0), (w - 1, h - 1))
+
+    def check_failsafe(self):
+        pointer = self._root.query_pointer()
+        if (pointer.root_x, pointer.root_y) in self._failsafe_points:
+            raise FailSafeException("Fail-safe triggered from mouse moving to a corner of the screen")
+
+    def close(self):
+        self._display.close()
+
+    def _down(self, x:int, y:int):
+        self._xtest.fake_input(self._display, self._X.MotionNotify, x=x, y=y)
+        self._xtest.fake_input(self._display, self._X.ButtonPress, 1)
+
+    def _move(self, x:int, y:int):
+        self._xtest.fake_input(self._display, self._X.MotionNotify, x=x, y=y)
+
+    def _up(self, x:int, y:int):
+        self._xtest.fake_input(self._display, self._X.ButtonRelease, 1)
+
+    def _flush(self):
+        self._display.sync()
+
+
+class RecordingInputBackend(InputBackend):
+    """Fake input backend that records the events with timestamps instead of sending them,
+    used for headless tests and benchmarks.
+    """
+
+    BATCHED = False
+
+    def __init__(self, event_interval:float=0, batched:bool=False):
+        super().__init__(event_interval)
+        self.BATCHED = batched
+        self.records:"list[tuple]" = []
+        self.flushes = 0
+        self.failsafe_armed = False
+
+    def check_failsafe(self):
+        if self.failsafe_armed:
+            raise FailSafeException("Fail-safe triggered by the recording backend")
+
+    def clear(self):
+        self.records.clear()
+        self.flushes = 0
+
+    def stats(self, chars:int=0):
+        """Gets the throughput of the recorded events.
+
+        :param chars: The count of drawn chars, used to calculate the time per char;
+        :returns: A dict containing the counts, events per second and milliseconds per char;
+        :rtype: dict;
+        """
+        if len(self.records) < 2:
+            span = 0
+        else:
+            span = (self.records[-1][0] - self.records[0][0]) / 1e9
+        strokes = sum(1 for r in self.records if r[1] == StrokeCompiler.EV_DOWN)
+        return {
+            'events': len(self.records),
+            'strokes': strokes,
+            'flushes': self.flushes,
+            'seconds': span,
+            'events_per_sec': len(self.records) / span if span > 0 else None,
+            'ms_per_char': span * 1000 / chars if chars else None
+        }
+
+    def _record(self, op:int, x:int, y:int):
+        self.records.append((time.perf_counter_ns(), op, x, y))
+
+    def _down(self, x:int, y:int):
+        self._record(StrokeCompiler.EV_DOWN, x, y)
+
+    def _move(self, x:int, y:int):
+        self._record(StrokeCompiler.EV_MOVE, x, y)
+
+    def _up(self, x:int, y:int):
+        self._record(StrokeCompiler.EV_UP, x, y)
+
+    def _flush(self):
+        self.flushes += 1
+
+
+class _ScheduledPlay:
+    def __init__(self, strokes:list, is_cancelled:Callable):
+        self.strokes = deque(strokes)
+        self.is_cancelled = is_cancelled
+        self.result = None
+        self.exception:BaseException = None
+        self.done = threading.Event()
+
+    def finish(self, result:bool, exception:BaseException=None):
+        self.result = result
+        self.exception = exception
+        self.done.set()
+
+
+class ScheduledInputBackend(InputBackend):
+    """Input backend of one session, which plays its events through the shared `InputScheduler`.
+    Playing blocks until all the strokes have been played by the scheduler.
+    """
+
+    def __init__(self, scheduler:"InputScheduler"):
+        super().__init__()
+        self._scheduler = scheduler
+        self._plays:"deque[_ScheduledPlay]" = deque()
+        self.strokes_played = 0
+
+    def play(self, events:tuple, is_cancelled:Callable=None):
+        return self._scheduler._play(self, events, is_cancelled)
+
+    def check_failsafe(self):
+        self._scheduler.check_failsafe()
+
+
+class InputScheduler:
+    """Serializes the input of several sessions through one real backend.
+
+    The events of each session are split into strokes, and a single worker thread plays one stroke of every
+    session with pending strokes in turn (round-robin), so a long answer of one session cannot starve the others.
+    A triggered fail-safe fails the pending plays of all the sessions.
+    """
+
+    def __init__(self, backend:InputBackend):
+        self._backend = backend
+        self._clients:"list[ScheduledInputBackend]" = []
+        self._cond = threading.Condition()
+        self._thread:threading.Thread = None
+        self._next = 0
+        self._failsafe:FailSafeException = None
+
+    def create_backend(self):
+        """Creates the input backend of a new session.
+
+        :returns: The backend instance;
+        :rtype: ScheduledInputBackend;
+        """
+        client = ScheduledInputBackend(self)
+        with self._cond:
+            self._clients.append(client)
+        return client
+
+    def check_failsafe(self):
+        if self._failsafe:
+            raise self._failsafe
+        self._backend.check_failsafe()
+
+    def close(self):
+        self._backend.close()
+
+    def stats(self):
+        return {'strokes_played': [c.strokes_played for c in self._clients]}
+
+    def _play(self, client:ScheduledInputBackend, events:tuple, is_cancelled:Callable):
+        strokes = []
+        begin = 0
+        for idx, event in enumerate(events):
+            if event[0] == StrokeCompiler.EV_UP:
+                strokes.append(events[begin:idx + 1])
+                begin = idx + 1
+        if begin < len(events):
+            strokes.append(events[begin:])
+        play = _ScheduledPlay(strokes, is_cancelled)
+        with self._cond:
+            if self._failsafe:
+                raise self._failsafe
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(name="InputScheduler", target=self._worker, daemon=True)
+                self._thread.start()
+            client._plays.append(play)
+            self._cond.notify_all()
+        play.done.wait()
+        if play.exception:
+            raise play.exception
+        return play.result
+
+    def _take(self):
+        # Picks the next session with pending strokes, starting after the last picked one
+        n = len(self._clients)
+        for i in range(n):
+            client = self._clients[(self._next + i) % n]
+            if client._plays:
+                self._next = (self._next + i + 1) % n
+                return client
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                client = self._cond.wait_for(self._take)
+                play = client._plays[0]
+                stroke = play.strokes.popleft() if play.strokes else None
+            if stroke is None or (play.is_cancelled and play.is_cancelled()):
+                with self._cond:
+                    client._plays.popleft()
+                play.finish(stroke is None)
+                continue
+            try:
+                self._backend.play(stroke)
+                client.strokes_played += 1
+            except FailSafeException as arg:
+                with self._cond:
+                    self._failsafe = arg
+                    for c in self._clients:
+                        while c._plays:
+                            c._plays.popleft().finish(False, arg)
+                return
+            except BaseException as arg:
+                with self._cond:
+                    client._plays.popleft()
+                play.finish(False, arg)
+                continue
+            if not play.strokes:
+                with self._cond:
+                    client._plays.popleft()
+                play.finish(True)
+
+
+def create_input_backend(name:str="pyautogui", event_interval:float=None):
+    """Creates a pointer input backend by name.
+
+    :param name: `"pyautogui"`, `"xtest"`, `"auto"` (prefers XTest and falls back to PyAutoGUI)
+        or `"recording"` (sends nothing, see `RecordingInputBackend`);
+    :param event_interval: The seconds to sleep after every event, `None` to use the default of the backend;
+    :returns: The backend instance;
+    :rtype: InputBackend;
+    """
+    kwargs = {} if event_interval is None else {'event_interval': event_interval}
+    if name in ("auto", "xtest"):
+        try:
+            return XTestInputBackend(**kwargs)
+        except Exception as arg:
+            if name == "xtest":
+                raise arg
+            Logger.info(f"InputBackend: XTest is unavailable ({arg}), falling back to PyAutoGUI")
+    if name in ("auto", "pyautogui"):
+        return PyAutoGUIInputBackend(**kwargs)
+    if name == "recording":
+        return RecordingInputBackend(**kwargs)
+    raise ValueError(f"Unknown input backend '{name}'")
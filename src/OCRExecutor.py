@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import os
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from .GlyphCache import GlyphCache
+from .Recognizer import Recognizer
+from .utils.AnalyUtils import TestRT
+from .utils.Logger import Logger
+
+
+class OCRExecutor:
+    """Base class of the OCR execution modes, which runs the glyph classification inline.
+
+    The preprocessing and the segmentation always run on the calling thread,
+    while the subclasses distribute the classification of the glyph boxes to workers.
+    """
+
+    MODE = "inline"
+    MIN_CHUNK = 4
+
+    def __init__(self, recognizer:Recognizer, workers:int=1):
+        self._recognizer = recognizer
+        self._workers = max(1, workers)
+
+    @property
+    def recognizer(self):
+        return self._recognizer
+
+    @property
+    def glyph_cache(self):
+        return self._recognizer.glyph_cache
+
+    def recognize(self, image:cv2.typing.MatLike):
+        with TestRT(f"recognize_{self.MODE}"):
+            image = Recognizer.preprocess(image, self._recognizer.frame_buffer(image.shape[:2]))
+            return self.recognize_boxes(image, self._recognizer.char_boxes(image))
+
+    def recognize_boxes(self, image:cv2.typing.MatLike, boxes:list):
+        """Recognizes the glyphs in the given boxes of the preprocessed image and joins the labels.
+
+        :param image: The preprocessed single-channel image;
+        :param boxes: The boxes returned by `Recognizer.char_boxes`;
+        :returns: The recognized string;
+        :rtype: str;
+        """
+        return self._recognizer.recognize_boxes(image, boxes)
+
+    def warm_up(self):
+        """Starts the workers and loads the templates in advance.
+
+        :rtype: None;
+        """
+        self._recognizer.classifier(Recognizer.T_CHARS)
+
+    def close(self):
+        pass
+
+    def _chunks(self, items:list):
+        size = max(OCRExecutor.MIN_CHUNK, -(-len(items) // self._workers))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class ThreadOCRExecutor(OCRExecutor):
+    """OCR execution mode that classifies the glyph boxes on a thread pool,
+    relying on OpenCV and NumPy releasing the GIL while resampling and matching.
+    """
+
+    MODE = "thread"
+
+    def __init__(self, recognizer:Recognizer, workers:int=1):
+        super().__init__(recognizer, workers)
+        self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix="OCRWorker")
+
+    def recognize_boxes(self, image:cv2.typing.MatLike, boxes:list):
+        chunks = self._chunks(boxes)
+        if len(chunks) <= 1:
+            return self._recognizer.recognize_boxes(image, boxes)
+        futures = [self._pool.submit(self._recognizer.recognize_boxes, image, c) for c in chunks]
+        return "".join(f.result() for f in futures)
+
+    def warm_up(self):
+        super().warm_up()
+        for f in [self._pool.submit(int) for _ in range(self._workers)]:
+            f.result()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+# Shared memory segments attached by the current worker process
+_attached:"dict[str,shared_memory.SharedMemory]" = {}
+
+
+def _init_process_worker(engine:str):
+    # Pre-warm the templates, so the first task doesn't pay for loading them
+    getattr(Recognizer.T_CHARS, Recognizer.ENGINES[engine])
+
+
+def _classify_shared(name:str, shape:tuple, boxes:list, top_k:int, engine:str):
+    shm = _attached.get(name, None)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    bank = getattr(Recognizer.T_CHARS, Recognizer.ENGINES[engine])
+    results = [bank.classify(image[y0:y1, x0:x1], top_k) for x0, x1, y0, y1 in boxes]
+    del image
+    return results
+
+
+class ProcessOCRExecutor(OCRExecutor):
+    """OCR execution mode that classifies the glyph boxes on a process pool.
+
+    The preprocessed frame is written into a shared memory segment, so only the segment name and the box
+    coordinates are pickled. The glyph cache stays in the calling process, and only the missed glyphs are sent.
+    """
+
+    MODE = "process"
+
+    def __init__(self, recognizer:Recognizer, workers:int=1):
+        super().__init__(recognizer, workers)
+        if os.name == 'posix':
+            # The workers must share the resource tracker of this process, otherwise each of them
+            # would regard the attached segments as its own and unlink them when exiting
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+        self._pool = ProcessPoolExecutor(self._workers, initializer=_init_process_worker,
+                                         initargs=(recognizer.engine,))
+        self._segments:"list[shared_memory.SharedMemory]" = []
+        self._free:"list[shared_memory.SharedMemory]" = []
+        self._lock = threading.Lock()
+
+    def recognize_boxes(self, image:cv2.typing.MatLike, boxes:list):
+        glyph_cache = self._recognizer.glyph_cache
+        labels = [None] * len(boxes)
+        keys = [None] * len(boxes)
+        missed = []
+        for idx, (x0, x1, y0, y1) in enumerate(boxes):
+            if x1 <= x0 or y1 <= y0:
+                labels[idx] = ""
+                continue
+            if glyph_cache is not None:
+                keys[idx] = GlyphCache.signature(image[y0:y1, x0:x1])
+                cached = glyph_cache.get(keys[idx])
+                if cached is not None:
+                    labels[idx] = cached[0]
+                    continue
+            missed.append(idx)
+        if missed:
+            image = np.ascontiguousarray(image)
+            shm = self._acquire_segment(image.nbytes)
+            try:
+                np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)[...] = image
+                chunks = self._chunks(missed)
+                futures = [self._pool.submit(_classify_shared, shm.name, image.shape, [boxes[i] for i in c],
+                                           Recognizer.CASCADE_TOP_K, self._recognizer.engine) for c in chunks]
+                for c, f in zip(chunks, futures):
+                    for idx, (label, confidence) in zip(c, f.result()):
+                        accepted = label if confidence >= Recognizer.T_THRESHOLD else ""
+                        labels[idx] = accepted
+                        if glyph_cache is not None:
+                            glyph_cache.put(keys[idx], accepted, confidence)
+            finally:
+                self._release_segment(shm)
+        return "".join(labels)
+
+    def warm_up(self):
+        super().warm_up()
+        for f in [self._pool.submit(int) for _ in range(self._workers)]:
+            f.result()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            for shm in self._segments:
+                shm.close()
+                shm.unlink()
+            self._segments.clear()
+            self._free.clear()
+
+    def _acquire_segment(self, size:int):
+        with self._lock:
+            for shm in self._free:
+                if shm.size >= size:
+                    self._free.remove(shm)
+                    return shm
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1 << 20))
+            self._segments.append(shm)
+            Logger.debug(f"OCRExecutor: Created shared memory of {shm.size} bytes")
+            return shm
+
+    def _release_segment(self, shm:shared_memory.SharedMemory):
+        with self._lock:
+            self._free.append(shm)
+
+
+def create_ocr_executor(mode:str, recognizer:Recognizer, workers:int=1):
+    """Creates an OCR executor by mode.
+
+    :param mode: `"inline"`, `"thread"` or `"process"`;
+    :param recognizer: The recognizer to use;
+    :param workers: The count of workers, ignored by the inline mode;
+    :returns: The executor instance;
+    :rtype: OCRExecutor;
+    """
+    if mode == "inline":
+        return OCRExecutor(recognizer)
+    if mode == "thread":
+        return ThreadOCRExecutor(recognizer, workers)
+    if mode == "process":
+        return ProcessOCRExecutor(recognizer, workers)
+    raise ValueError(f"Unknown OCR mode '{mode}'")
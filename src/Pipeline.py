@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import queue
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable
+from .Calculator import Calculator
+from .Calibrator import RegionCalibrator
+from .CaptureBackend import CaptureBackend, SharedCaptureBackend
+from .InputBackend import InputBackend, InputScheduler
+from .OCRExecutor import OCRExecutor
+from .PlayerAgent import PlayerAgent, TimeGateCache, FrameDiffGate
+from .Poller import AdaptivePoller, DamagePoller, create_poller
+from .Recognizer import Recognizer
+from .utils.AnalyUtils import TestRT
+from .utils.Config import PerformanceLevel
+from .utils.Logger import Logger
+
+
+class PipelineStage(threading.Thread):
+    """Worker thread of a pipeline stage.
+
+    The stage takes items from its input queue, processes them with the handler and puts the non-`None`
+    results into its output queue. Putting into a full output queue blocks, so a slow stage applies
+    backpressure to the stages before it. A stage without input queue is a source, whose handler will
+    be invoked repeatedly at the given interval, or paced by the given poller.
+    The handler spans are recorded in `TestRT` by the stage name.
+    """
+
+    def __init__(self, name:str, handler:Callable, in_queue:queue.Queue, out_queue:queue.Queue,
+                 stop_event:threading.Event, interval:float=0, on_exit:Callable=None, poller:AdaptivePoller=None):
+        super().__init__(name=name, daemon=True)
+        self._handler = handler
+        self._in = in_queue
+        self._out = out_queue
+        self._stop_event = stop_event
+        self._interval = interval
+        self._on_exit = on_exit
+        self._poller = poller
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if self._in is None:
+                item = None
+            else:
+                try:
+                    item = self._in.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+            begin = time.perf_counter_ns()
+            try:
+                result = self._handler(item)
+            except SystemExit:
+                if self._on_exit:
+                    self._on_exit()
+                return
+            except Exception as arg:
+                Logger.warn(f"{self.name}: {type(arg).__name__}: {arg}")
+                result = None
+            if self._in is not None or result is not None:
+                # The span of a source stage is recorded only when it produces an item
+                TestRT.record(self.name, time.perf_counter_ns() - begin)
+            if result is not None and self._out is not None:
+                self._put(result)
+            if self._in is None:
+                if self._poller:
+                    self._poller.wait()
+                elif self._interval > 0:
+                    time.sleep(self._interval)
+
+    def _put(self, item:object):
+        while not self._stop_event.is_set():
+            try:
+                self._out.put(item, timeout=0.05)
+                return
+            except queue.Full:
+                continue
+
+
+class SolvePipeline:
+    """Staged solve loop: capture -> recognize -> solve -> draw.
+
+    Each stage runs on its own worker thread and the stages are connected by bounded queues,
+    so the recognition of the next question overlaps with the drawing of the current one.
+    The question in `PlayerAgent.REGION_NEXT_QUESTION` is recognized and solved in advance,
+    so its answer is ready when it becomes the current question.
+    The caller receives status events from `poll_status` only.
+    The recognizer can also be an `OCRExecutor`, which has the same `recognize` method.
+    If an executor is given, the recognition runs on it instead of the stage worker.
+    The capture rate is adapted to the game state by an `AdaptivePoller`, or driven by the screen damage
+    of the question region if `trigger` is `"damage"` (see `create_poller`).
+    If `stream_draw` is set, the answers are drawn through `AnswerStream` in fixed-width cells.
+    If `calibrate_every` is positive, the game region is verified by a `RegionCalibrator` every so many captures,
+    and it is located again near the old one after `LOST_LIMIT` failed verifications in a row.
+    If a shared `poller` is given, the pipeline has no capture stage of its own, and its captures are driven by
+    the owner of the poller through `_capture_frame` (see `MultiSessionPipeline`).
+    """
+
+    PRESOLVED_LIMIT = 8
+    STATUS_LIMIT = 64
+    LOST_LIMIT = 3
+    DRAW_WAIT_INTERVAL = 0.1
+
+    def __init__(self, agent:PlayerAgent, recognizer:"Recognizer|OCRExecutor", calculator:Calculator,
+                 interval:float=0.01, queue_size:int=1, executor:Executor=None,
+                 expire_time:float=2.5, max_interval:float=0.5, stream_draw:bool=False, trigger:str="poll",
+                 calibrate_every:int=0, poller:AdaptivePoller=None):
+        self._agent = agent
+        self._recognizer = recognizer
+        self._calculator = calculator
+        self._interval = interval
+        self._executor = executor
+        self._stream_draw = stream_draw
+        self._shared_poller = poller is not None
+        self._poller = poller
+        if poller is None:
+            self._poller = create_poller(trigger, agent.get_screen_rect(PlayerAgent.REGION_THIS_QUESTION),
+                                         interval, max_interval)
+        self._present = False
+        self._this_gate = FrameDiffGate(expire_time=expire_time)
+        self._next_gate = FrameDiffGate(expire_time=expire_time)
+        self._this_cache = TimeGateCache(expire_time=expire_time)
+        self._presolved:"OrderedDict[str,str]" = OrderedDict()
+        self._presolved_hits = 0
+        self._answered = 0
+        self._drawing:tuple = None
+        self._status = queue.Queue(SolvePipeline.STATUS_LIMIT)
+        self._stop_event = threading.Event()
+        self._resume_event = threading.Event()
+        self._resume_event.set()
+        self._stages:"list[PipelineStage]" = []
+        self._frames:queue.Queue = None
+        self._queue_size = queue_size
+        self._rings:"dict[str,list]" = {}
+        (l, t), (r, b) = agent.region
+        self._calibrator = RegionCalibrator((r - l) / (b - t))
+        self._calibrate_every = calibrate_every
+        self._captures = 0
+        self._lost = 0
+
+    @property
+    def this_gate(self):
+        return self._this_gate
+
+    @property
+    def poller(self):
+        return self._poller
+
+    @property
+    def regions(self):
+        return [self._agent.region]
+
+    def calibrate(self, near:bool=False):
+        """Locates the game region again and moves the agent to it if found.
+
+        :param near: Whether to search only the neighbourhood of the current region, otherwise the whole screen;
+        :returns: `True` if the region is located;
+        :rtype: bool;
+        """
+        region = self._calibrator.locate_on(self._agent.capture_backend, self._agent.region if near else None)
+        if region is None:
+            Logger.info("SolvePipeline: Failed to locate the game region.")
+            return False
+        self._lost = 0
+        if region != self._agent.region:
+            Logger.info(f"SolvePipeline: Located the game region at {region}.")
+            self._agent.set_region(*region)
+            if isinstance(self._poller, DamagePoller) and not self._shared_poller:
+                self._poller.rect = self._agent.get_screen_rect(PlayerAgent.REGION_THIS_QUESTION)
+            self._this_gate.reset()
+            self._next_gate.reset()
+            self._emit({'type': 'region', 'region': [list(region[0]), list(region[1])]})
+        return True
+
+    def start(self):
+        """Starts all the stage workers.
+
+        :rtype: None;
+        """
+        self._frames = queue.Queue(self._queue_size)
+        questions = queue.Queue(self._queue_size)
+        answers = queue.Queue(self._queue_size)
+        self._stages = [
+            PipelineStage("RecognizeStage", self._recognize, self._frames, questions, self._stop_event,
+                          on_exit=self._on_exit),
+            PipelineStage("SolveStage", self._solve, questions, answers, self._stop_event, on_exit=self._on_exit),
+            PipelineStage("DrawStage", self._draw, answers, None, self._stop_event, on_exit=self._on_exit)
+        ]
+        if not self._shared_poller:
+            self._stages.insert(0, PipelineStage("CaptureStage", self._capture, None, self._frames, self._stop_event,
+                                                 self._interval, self._on_exit, self._poller))
+        for s in self._stages:
+            s.start()
+
+    def stop(self, timeout:float=1):
+        """Stops all the stage workers and waits for them to finish.
+
+        :param timeout: The maximum seconds to wait for each worker;
+        :rtype: None;
+        """
+        self._stop_event.set()
+        self._resume_event.set()
+        drawing = self._drawing
+        if drawing:
+            # Cancelling also aborts an answer stream, so the drawing worker stops before its next char
+            drawing[1].cancel()
+        for s in self._stages:
+            if s is not threading.current_thread():
+                s.join(timeout)
+        if not self._shared_poller:
+            self._poller.close()
+
+    def pause(self):
+        self._resume_event.clear()
+
+    def resume(self):
+        self._resume_event.set()
+
+    @property
+    def paused(self):
+        return not self._resume_event.is_set()
+
+    def poll_status(self):
+        """Drains the pending status events. Each event is a dict with a `type` field.
+
+        :returns: The list of events;
+        :rtype: list;
+        """
+        events = []
+        while True:
+            try:
+                events.append(self._status.get_nowait())
+            except queue.Empty:
+                return events
+
+    def stats(self):
+        return {
+            'answered': self._answered,
+            'presolved_hits': self._presolved_hits,
+            'frame_gate': self._this_gate.stats(),
+            'poller': self._poller.stats()
+        }
+
+    def _emit(self, event:dict):
+        try:
+            self._status.put_nowait(event)
+        except queue.Full:
+            # Drop the oldest event, the newest status is always more useful
+            try:
+                self._status.get_nowait()
+            except queue.Empty:
+                pass
+            self._emit(event)
+
+    def _on_exit(self):
+        self._emit({'type': 'exit'})
+        self.stop()
+
+    def _capture(self, _):
+        self._resume_event.wait()
+        item, state = self._capture_frame()
+        self._poller.report(state)
+        return item
+
+    def _capture_frame(self):
+        """Captures the question regions once.
+
+        :returns: A tuple of the frame item for the recognition (`None` if unchanged) and the state for the poller;
+        :rtype: tuple;
+        """
+        self._captures += 1
+        if self._calibrate_every > 0 and self._captures % self._calibrate_every == 0:
+            self._verify_region()
+        this_image = self._agent.get_screen_image(PlayerAgent.REGION_THIS_QUESTION)
+        this_changed = self._this_gate.update(this_image)
+        if this_changed:
+            # A question region is bright with dark glyphs
+            self._present = bool(np.average(this_image) > 196 and np.min(this_image) < 24)
+            this_changed = self._present
+        next_image = self._agent.get_screen_image(PlayerAgent.REGION_NEXT_QUESTION)
+        next_changed = self._next_gate.update(next_image)
+        if this_changed or next_changed:
+            # Copy the frames since the capture buffers are reused
+            return ((time.time(), self._hold('this', this_image) if this_changed else None,
+                     self._hold('next', next_image) if next_changed else None), AdaptivePoller.DETECTED)
+        return (None, AdaptivePoller.IDLE if self._present else AdaptivePoller.ABSENT)
+
+    def _verify_region(self):
+        if self._calibrator.verify(self._agent.get_screen_image()):
+            self._lost = 0
+            return
+        self._lost += 1
+        if self._lost >= SolvePipeline.LOST_LIMIT:
+            # Drifted, or the game is not showing, which will be verified again later
+            self._lost = 0
+            self.calibrate(near=True)
+
+    def _hold(self, key:str, image:np.ndarray):
+        """Copies the captured frame into the next buffer of a ring, instead of allocating a new frame.
+        The ring has a buffer for each frame waiting in the queue, the frame being recognized and the frame being captured.
+
+        :param key: The name of the ring;
+        :param image: The captured frame;
+        :returns: The copied frame;
+        :rtype: np.ndarray;
+        """
+        ring = self._rings.get(key, None)
+        if ring is None or ring[0].shape != image.shape:
+            ring = [np.empty_like(image) for _ in range(self._queue_size + 2)]
+            self._rings[key] = ring
+        buffer = ring.pop(0)
+        ring.append(buffer)
+        np.copyto(buffer, image)
+        return buffer
+
+    def _recognize(self, frame:tuple):
+        timestamp, this_image, next_image = frame
+        if self._executor:
+            this_qst = self._executor.submit(self._recognizer.recognize, this_image) if this_image is not None else None
+            next_qst = self._executor.submit(self._recognizer.recognize, next_image) if next_image is not None else None
+            this_qst = this_qst.result() if this_qst else None
+            next_qst = next_qst.result() if next_qst else None
+        else:
+            this_qst = self._recognizer.recognize(this_image) if this_image is not None else None
+            next_qst = self._recognizer.recognize(next_image) if next_image is not None else None
+        return (timestamp, this_qst, next_qst) if this_qst or next_qst else None
+
+    def _solve(self, question:tuple):
+        timestamp, this_qst, next_qst = question
+        if next_qst and next_qst not in self._presolved:
+            next_ans = self._calculator.solve(next_qst, ignore_error=True)
+            if next_ans:
+                self._presolved[next_qst] = next_ans
+                while len(self._presolved) > SolvePipeline.PRESOLVED_LIMIT:
+                    self._presolved.popitem(last=False)
+        if this_qst:
+            drawing = self._drawing
+            if drawing and drawing[0] != this_qst and self._calculator.solve(this_qst, ignore_error=True):
+                # The question changed to another valid one, the answer being drawn is stale
+                drawing[1].cancel()
+            this_ans = self._presolved.get(this_qst, None)
+            if this_ans:
+                self._presolved_hits += 1
+            else:
+                this_ans = self._calculator.solve(this_qst, ignore_error=True)
+            if this_ans and self._this_cache.update(this_qst.replace('U', '')):
+                return (timestamp, this_qst, this_ans)
+        return None
+
+    def _draw(self, answer:tuple):
+        timestamp, this_qst, this_ans = answer
+        Logger.info(f"Question: {this_qst} (Answer: {this_ans})")
+        self._emit({'type': 'answer', 'question': this_qst, 'answer': this_ans, 'timestamp': timestamp})
+        if self._stream_draw:
+            job = self._agent.stream_answer(ignore_error=True)
+            job.put(this_ans)
+            job.close()
+        else:
+            job = self._agent.async_draw_answer(this_ans, ignore_error=True)
+        self._drawing = (this_qst, job)
+        while not job.wait(SolvePipeline.DRAW_WAIT_INTERVAL):
+            if self._stop_event.is_set():
+                job.cancel()
+                break
+        self._drawing = None
+        self._poller.notify_draw_done()
+        if isinstance(job.exception, SystemExit):
+            raise job.exception
+        if not job.cancelled:
+            self._answered += 1
+        return None
+
+
+class MultiSessionPipeline:
+    """Drives several game regions (sessions) from one process, each by its own `SolvePipeline`.
+
+    All the sessions share the recognizer and a recognition worker pool sized by the performance level.
+    Their captures are driven by one capture stage: every tick grabs the bounding box of their regions once
+    through a `SharedCaptureBackend`, then captures the sessions from it, paced by one shared poller.
+    The bounding box follows the regions when a session is calibrated. Their input is serialized by an
+    `InputScheduler` which interleaves the strokes of the sessions. The status events carry the index of their session.
+    """
+
+    def __init__(self, regions:list, recognizer:"Recognizer|OCRExecutor", calculator:Calculator,
+                 capture_backend:CaptureBackend, input_backend:InputBackend,
+                 performance_level:int=PerformanceLevel.STANDARD, interval:float=0.01,
+                 expire_time:float=2.5, max_interval:float=0.5, trigger:str="poll", calibrate_every:int=0):
+        if not regions:
+            raise ValueError("At least one region is required")
+        self._interval = interval
+        self._capture = SharedCaptureBackend(capture_backend, regions)
+        self._scheduler = InputScheduler(input_backend)
+        self._executor = ThreadPoolExecutor(PerformanceLevel.get_thread_limit(performance_level),
+                                            thread_name_prefix="RecognizeWorker")
+        agents = [PlayerAgent(lt, rb, self._capture, self._scheduler.create_backend()) for lt, rb in regions]
+        self._poller = create_poller(trigger, MultiSessionPipeline._question_rect(agents), interval, max_interval)
+        self._sessions = [SolvePipeline(a, recognizer, calculator, interval, executor=self._executor,
+                                        expire_time=expire_time, max_interval=max_interval,
+                                        calibrate_every=calibrate_every, poller=self._poller)
+                          for a in agents]
+        self._synced_regions = self.regions
+        self._states = [AdaptivePoller.ABSENT] * len(self._sessions)
+        self._stop_event = threading.Event()
+        self._stage:PipelineStage = None
+
+    @property
+    def sessions(self):
+        return self._sessions
+
+    @property
+    def regions(self):
+        return [s.regions[0] for s in self._sessions]
+
+    def calibrate(self):
+        """Locates the game region of every session again near its current one, since the windows are side by side.
+
+        :returns: `True` if all the regions are located;
+        :rtype: bool;
+        """
+        return all([s.calibrate(near=True) for s in self._sessions])
+
+    def start(self):
+        for s in self._sessions:
+            s.start()
+        self._stage = PipelineStage("CaptureStage", self._capture_all, None, None, self._stop_event,
+                                    self._interval, self.stop, self._poller)
+        self._stage.start()
+
+    def stop(self, timeout:float=1):
+        self._stop_event.set()
+        if self._stage and self._stage is not threading.current_thread():
+            self._stage.join(timeout)
+        for s in self._sessions:
+            s.stop(timeout)
+        self._poller.close()
+        self._executor.shutdown(wait=False)
+
+    def pause(self):
+        for s in self._sessions:
+            s.pause()
+
+    def resume(self):
+        for s in self._sessions:
+            s.resume()
+
+    @property
+    def paused(self):
+        return all(s.paused for s in self._sessions)
+
+    def poll_status(self):
+        """Drains the pending status events of all the sessions. Each event has an extra `session` field.
+
+        :returns: The list of events;
+        :rtype: list;
+        """
+        events = []
+        for idx, s in enumerate(self._sessions):
+            for e in s.poll_status():
+                e['session'] = idx
+                events.append(e)
+        return events
+
+    def stats(self):
+        return {
+            'sessions': [s.stats() for s in self._sessions],
+            'capture': self._capture.stats(),
+            'poller': self._poller.stats(),
+            'input': self._scheduler.stats()
+        }
+
+    def _capture_all(self, _):
+        self._sync_regions()
+        # A session whose frame queue is full is skipped, so that it doesn't hold up the others
+        active = [i for i, s in enumerate(self._sessions) if not s.paused]
+        sessions = [i for i in active if not self._sessions[i]._frames.full()]
+        if sessions:
+            self._capture.refresh(PlayerAgent.GRAYSCALE_CAPTURE)
+        for i in sessions:
+            item, self._states[i] = self._sessions[i]._capture_frame()
+            if item is not None:
+                # Only this stage puts into the queue, which is not full
+                self._sessions[i]._frames.put_nowait(item)
+        # A skipped session is still busy, so its last state is reported rather than an absence
+        states = set(self._states[i] for i in active)
+        if AdaptivePoller.DETECTED in states:
+            self._poller.report(AdaptivePoller.DETECTED)
+        else:
+            self._poller.report(AdaptivePoller.IDLE if AdaptivePoller.IDLE in states else AdaptivePoller.ABSENT)
+        return None
+
+    def _sync_regions(self):
+        regions = self.regions
+        if regions != self._synced_regions:
+            self._synced_regions = regions
+            self._capture.set_regions(regions)
+            if isinstance(self._poller, DamagePoller):
+                self._poller.rect = MultiSessionPipeline._question_rect([s._agent for s in self._sessions])
+
+    @staticmethod
+    def _question_rect(agents:"list[PlayerAgent]"):
+        rects = [a.get_screen_rect(PlayerAgent.REGION_THIS_QUESTION) for a in agents]
+        return (min(r[0] for r in rects), min(r[1] for r in rects), max(r[2] for r in rects), max(r[3] for r in rects))
@@ -4,14 +4,16 @@
 import cv2
 import time
 import json
+import queue
 import threading
 import numpy as np
-import pyautogui as pag
+from .CaptureBackend import CaptureBackend, create_capture_backend
+from .InputBackend import InputBackend, FailSafeException, create_input_backend
+from .StrokeCompiler import StrokeCompiler
 from .utils.AnalyUtils import TestRT
+from .utils.Assets import BUNDLE_PATH, LazyAsset, get_asset_path, is_bundle_fresh, load_bundle
 from .utils.Logger import Logger
 
-pag.PAUSE = 0.04
-
 
 class TimeGateCache:
     def __init__(self, expire_time:float=0):
@@ -28,70 +30,239 @@ class TimeGateCache:
             return False
 
 
+class FrameDiffGate:
+    """Cheap change detector for captured frames.
+    A frame is compared with the last accepted one by a downsampled signature,
+    so an unchanged frame can skip recognition and solving entirely.
+    """
+
+    def __init__(self, signature_size:tuple=(32, 8), tolerance:int=4, expire_time:float=0):
+        self._size = signature_size
+        self._tolerance = tolerance
+        self._expire = expire_time
+        self._signature:np.ndarray = None
+        self._create_at = 0
+        self.frames_checked = 0
+        self.frames_skipped = 0
+
+    def update(self, image:cv2.typing.MatLike):
+        """Checks whether the given frame differs from the last accepted one.
+        An unchanged frame is still accepted once the last accepted one has expired.
+
+        :param image: The captured frame;
+        :returns: `True` if the frame should be processed, otherwise `False`;
+        :rtype: bool;
+        """
+        self.frames_checked += 1
+        if image.size == 0:
+            self.frames_skipped += 1
+            return False
+        # Cropping to a multiple of the signature size lets the area interpolation take its fast path
+        h, w = image.shape[:2]
+        sw, sh = self._size
+        image = image[:h - h % sh if h >= sh else h, :w - w % sw if w >= sw else w]
+        signature = cv2.resize(image, self._size, interpolation=cv2.INTER_AREA).astype(np.int16)
+        if self._signature is not None and self._signature.shape == signature.shape and \
+                self._create_at + self._expire >= time.time() and \
+                int(np.max(np.abs(signature - self._signature))) <= self._tolerance:
+            self.frames_skipped += 1
+            return False
+        self._signature = signature
+        self._create_at = time.time()
+        return True
+
+    def reset(self):
+        self._signature = None
+
+    def stats(self):
+        return {
+            'frames_checked': self.frames_checked,
+            'frames_skipped': self.frames_skipped,
+            'skip_rate': self.frames_skipped / self.frames_checked if self.frames_checked else None
+        }
+
+
+class DrawJob:
+    """Handle of an answer submitted to the drawing worker of `PlayerAgent`."""
+
+    def __init__(self, answer:str, ignore_error:bool=False):
+        self.answer = answer
+        self.ignore_error = ignore_error
+        self.exception:BaseException = None
+        self.created_at = time.perf_counter_ns()
+        self._cancelled = False
+        self._stroked = False
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """Cancels this job. A pending job will be skipped, while a running job stops before its next char.
+
+        :returns: `False` if the job has already finished, otherwise `True`;
+        :rtype: bool;
+        """
+        if self._done.is_set():
+            return False
+        self._cancelled = True
+        return True
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout:float=None):
+        """Blocks until this job finishes, is cancelled or the timeout expires.
+
+        :param timeout: The maximum seconds to wait, `None` to wait forever;
+        :returns: `True` if the job finished;
+        :rtype: bool;
+        """
+        return self._done.wait(timeout)
+
+    def _finish(self, exception:BaseException=None):
+        self.exception = exception
+        self._done.set()
+
+
+class AnswerStream(DrawJob):
+    """Handle of an answer drawn char by char while it is still being produced.
+
+    Every char is written in a fixed-width cell of the answering region, so the first stroke starts as soon
+    as the leading char is put, without knowing the length of the answer. Aborting the stream stops the
+    drawing before its next char, the same as cancelling a job.
+    """
+
+    def __init__(self, ignore_error:bool=False):
+        super().__init__("", ignore_error)
+        self._chars:"queue.Queue[str]" = queue.Queue()
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, chars:str):
+        """Appends chars to the answer.
+
+        :param chars: The chars to append;
+        :rtype: None;
+        """
+        if self._closed:
+            raise RuntimeError("Cannot put into a closed answer stream")
+        self.answer += chars
+        for c in chars:
+            self._chars.put(c)
+
+    def close(self):
+        """Marks the end of the answer. The stream finishes once all the chars are drawn.
+
+        :rtype: None;
+        """
+        if not self._closed:
+            self._closed = True
+            self._chars.put(None)
+
+    def cancel(self):
+        cancelled = super().cancel()
+        # Wake up the drawing worker waiting for the next char
+        self._chars.put(None)
+        return cancelled
+
+    def abort(self):
+        """Aborts the stream, alias of `cancel`."""
+        return self.cancel()
+
+    def _next_char(self):
+        return self._chars.get()
+
+
+def _load_strokes():
+    if is_bundle_fresh():
+        strokes = {k[8:]: v for k, v in load_bundle(BUNDLE_PATH).items() if k.startswith('strokes/')}
+        if strokes:
+            return strokes
+    with open(get_asset_path('strokes.json'), 'r', encoding='UTF-8') as f:
+        return json.load(f)
+
+
 class PlayerAgent:
-    GRAYSCALE_CAPTURE = False
-    STROKES = json.load(open("assets/strokes.json"))
+    GRAYSCALE_CAPTURE = True
+    STROKES:dict = LazyAsset(_load_strokes)
 
     REGION_THIS_QUESTION = ((0.144, 0.171), (0.859, 0.266))
     REGION_NEXT_QUESTION = ((0.209, 0.296), (0.791, 0.364))
     REGION_ANSWERING = ((0.052, 0.449), (0.948, 0.916))
+    MAX_ANSWER_LENGTH = 9
 
-    def __init__(self, left_top:tuple, right_bottom:tuple):
+    def __init__(self, left_top:tuple, right_bottom:tuple, capture_backend:CaptureBackend=None, input_backend:InputBackend=None):
+        self._capture = capture_backend
+        self._input = input_backend
+        self._compiler = StrokeCompiler(PlayerAgent.STROKES)
         self._lt = tuple(left_top)
         self._rb = tuple(right_bottom)
         self._size = (right_bottom[0] - left_top[0], right_bottom[1] - left_top[1])
         self._screen_size:tuple = None
         self._draw_thread:threading.Thread = None
-        self._internal_lock = threading.Lock()
+        self._draw_stopped = True
+        self._draw_queue:"queue.Queue[DrawJob]" = queue.Queue()
+        self._draw_jobs:"list[DrawJob]" = []
+        self._internal_lock = threading.Condition()
+
+    @property
+    def region(self):
+        return (self._lt, self._rb)
+
+    @property
+    def capture_backend(self):
+        if self._capture is None:
+            self._capture = create_capture_backend()
+        return self._capture
+
+    def set_region(self, left_top:tuple, right_bottom:tuple):
+        """Moves the agent to another game region, which takes effect from the next capture or drawing.
+
+        :param left_top: The left-top corner of the game region;
+        :param right_bottom: The right-bottom corner of the game region;
+        :rtype: None;
+        """
+        self._lt = tuple(left_top)
+        self._rb = tuple(right_bottom)
+        self._size = (right_bottom[0] - left_top[0], right_bottom[1] - left_top[1])
 
     def get_screen_image(self, crop_by_lt_rb:tuple=None):
         with TestRT('get_screen_image'):
-            image = pag.screenshot().convert('RGB')
-            self._screen_size = image.size
-            cvt = cv2.COLOR_RGB2GRAY if PlayerAgent.GRAYSCALE_CAPTURE else cv2.COLOR_RGB2BGR
-            mat = cv2.cvtColor(np.array(image), cvt)
-            mat = PlayerAgent.crop_by_lt_rb(mat, self._lt, self._rb)
-            if crop_by_lt_rb:
-                mat = PlayerAgent.crop_by_lt_rb(mat, *crop_by_lt_rb, relative=True)
-            return mat
+            self._screen_size = self.capture_backend.screen_size
+            left, top, right, bottom = self.get_screen_rect(crop_by_lt_rb)
+            return self._capture.grab(left, top, right, bottom, PlayerAgent.GRAYSCALE_CAPTURE)
+
+    def get_screen_rect(self, crop_by_lt_rb:tuple=None):
+        left, top = int(self._lt[0]), int(self._lt[1])
+        right, bottom = int(self._rb[0]), int(self._rb[1])
+        if crop_by_lt_rb:
+            w, h = right - left, bottom - top
+            (rl, rt), (rr, rb) = crop_by_lt_rb
+            left, top, right, bottom = left + int(rl * w), top + int(rt * h), left + int(rr * w), top + int(rb * h)
+        return (left, top, right, bottom)
 
     def draw_strokes(self, left_top:tuple, right_bottom:tuple, strokes:list):
         with TestRT('draw_strokes'):
-            width = right_bottom[0] - left_top[0]
-            height = right_bottom[1] - left_top[1]
-            for idx, (x, y) in enumerate(strokes):
-                x = int(x * width + left_top[0])
-                y = int(y * height + left_top[1])
-                if idx == 0:
-                    pag.mouseDown(x, y, duration=0)
-                else:
-                    pag.moveTo(x, y, duration=0)
-                    if idx == len(strokes) - 1:
-                        pag.mouseUp(x, y, duration=0)
+            self._play_events(StrokeCompiler.compile_strokes(left_top, right_bottom, strokes))
 
-    def draw_answer(self, answer:str, ignore_error:bool=False):
+    def draw_answer(self, answer:str, ignore_error:bool=False, job:DrawJob=None):
         try:
             if answer:
-                if len(answer) < 10:
+                if len(answer) <= PlayerAgent.MAX_ANSWER_LENGTH:
                     if not self._screen_size:
                         raise RuntimeError("Screen size unknown, invoke 'get_screen_image' first")
-                    start_x = int(self._lt[0] + self._size[0] * PlayerAgent.REGION_ANSWERING[0][0])
-                    end_x = int(self._lt[0] + self._size[0] * PlayerAgent.REGION_ANSWERING[1][0])
-                    start_y = int(self._lt[1] + self._size[1] * PlayerAgent.REGION_ANSWERING[0][1])
-                    end_y = int(self._lt[1] + self._size[1] * PlayerAgent.REGION_ANSWERING[1][1])
-                    w_per_char = (end_x - start_x) // len(answer)
-                    cur_x = start_x
-                    for i in answer:
-                        if i not in PlayerAgent.STROKES:
-                            raise ValueError(f"Char '{i}' is not in strokes dict")
-                        strokes = PlayerAgent.STROKES[i]
-                        self.draw_strokes((cur_x, start_y), (cur_x + w_per_char, end_y), strokes)
-                        cur_x += w_per_char
+                    with TestRT('draw_answer'):
+                        self._play_events(self._compiler.compile(answer, *self.get_answering_rect()), job)
                 else:
                     raise ValueError("Argument answer is too long")
             else:
                 raise ValueError("Argument answer is empty or none")
-        except pag.FailSafeException:
+        except FailSafeException:
             Logger.error("FailSafe triggered")
             exit()
         except BaseException as arg:
@@ -99,16 +270,140 @@ class PlayerAgent:
             if not ignore_error:
                 raise arg
 
+    def draw_stream(self, stream:AnswerStream):
+        """Draws the chars of the stream as they are put. Since the length of the answer is unknown in advance,
+        the answering width is divided into `MAX_ANSWER_LENGTH` cells, so that the stream accepts any answer
+        that `draw_answer` accepts, and each char is drawn in the next cell.
+        Returns when the stream is closed and drained, or aborted.
+
+        :param stream: The answer stream;
+        :rtype: None;
+        """
+        try:
+            if not self._screen_size:
+                raise RuntimeError("Screen size unknown, invoke 'get_screen_image' first")
+            (left, top), (right, bottom) = self.get_answering_rect()
+            cell = (right - left) // PlayerAgent.MAX_ANSWER_LENGTH
+            index = 0
+            with TestRT('draw_stream'):
+                while not stream.cancelled:
+                    char = stream._next_char()
+                    if char is None or stream.cancelled:
+                        break
+                    if index >= PlayerAgent.MAX_ANSWER_LENGTH:
+                        raise ValueError("Argument answer is too long")
+                    x = left + index * cell
+                    self._play_events(self._compiler.compile_char(char, (x, top), (x + cell, bottom)), stream)
+                    index += 1
+        except FailSafeException:
+            Logger.error("FailSafe triggered")
+            exit()
+        except BaseException as arg:
+            Logger.warn(f"Cannot draw answer because: {arg}")
+            if not stream.ignore_error:
+                raise arg
+
+    def get_answering_rect(self):
+        left_top = (int(self._lt[0] + self._size[0] * PlayerAgent.REGION_ANSWERING[0][0]),
+                    int(self._lt[1] + self._size[1] * PlayerAgent.REGION_ANSWERING[0][1]))
+        right_bottom = (int(self._lt[0] + self._size[0] * PlayerAgent.REGION_ANSWERING[1][0]),
+                        int(self._lt[1] + self._size[1] * PlayerAgent.REGION_ANSWERING[1][1]))
+        return (left_top, right_bottom)
+
+    def _play_events(self, events:tuple, job:DrawJob=None):
+        if self._input is None:
+            self._input = create_input_backend()
+        if job and not job._stroked and events:
+            job._stroked = True
+            TestRT.record('first_stroke', time.perf_counter_ns() - job.created_at)
+        if not self._input.play(events, (lambda: job.cancelled) if job else None):
+            Logger.debug(f"Cancelled drawing '{job.answer}'")
+
     def async_draw_answer(self, answer:str, ignore_error:bool=False):
+        """Submits an answer to the persistent drawing worker.
+
+        :param answer: The answer to draw;
+        :param ignore_error: Whether to suppress the errors, which will be recorded in the job anyway;
+        :returns: The handle of the drawing job;
+        :rtype: DrawJob;
+        """
+        job = DrawJob(answer, ignore_error)
+        self._submit(job)
+        Logger.debug(f"Submitted drawing '{answer}'")
+        return job
+
+    def stream_answer(self, ignore_error:bool=False):
+        """Opens an answer stream on the persistent drawing worker, see `AnswerStream`.
+
+        :param ignore_error: Whether to suppress the errors, which will be recorded in the stream anyway;
+        :returns: The answer stream;
+        :rtype: AnswerStream;
+        """
+        stream = AnswerStream(ignore_error)
+        self._submit(stream)
+        Logger.debug("Opened answer stream")
+        return stream
+
+    def _submit(self, job:DrawJob):
         with self._internal_lock:
-            while not self.is_async_draw_idle():
-                pass
-            self._draw_thread = threading.Thread(target=self.draw_answer, args=(answer, ignore_error), daemon=True)
-            self._draw_thread.start()
-            Logger.debug(f"Thread started to draw '{answer}'")
+            if self._draw_stopped:
+                # The stopped worker has drained the queue, so a new one takes over
+                self._draw_stopped = False
+                self._draw_thread = threading.Thread(name="DrawWorker", target=self._draw_worker, daemon=True)
+                self._draw_thread.start()
+            self._draw_jobs.append(job)
+            self._draw_queue.put(job)
+
+    def cancel_async_draw(self):
+        """Cancels all the pending and running drawing jobs.
+
+        :returns: The count of cancelled jobs;
+        :rtype: int;
+        """
+        with self._internal_lock:
+            return sum(1 for j in self._draw_jobs if j.cancel())
 
     def is_async_draw_idle(self):
-        return not self._draw_thread or not self._draw_thread.is_alive()
+        with self._internal_lock:
+            return not self._draw_jobs
+
+    def wait_async_draw_idle(self, timeout:float=None):
+        """Blocks until all the submitted drawing jobs finish or the timeout expires.
+
+        :param timeout: The maximum seconds to wait, `None` to wait forever;
+        :returns: `True` if the drawing worker is idle;
+        :rtype: bool;
+        """
+        with self._internal_lock:
+            return self._internal_lock.wait_for(lambda: not self._draw_jobs, timeout)
+
+    def _draw_worker(self):
+        while True:
+            job = self._draw_queue.get()
+            exception = None
+            try:
+                if job.cancelled:
+                    pass
+                elif isinstance(job, AnswerStream):
+                    self.draw_stream(job)
+                else:
+                    self.draw_answer(job.answer, job.ignore_error, job)
+            except BaseException as arg:
+                exception = arg
+            with self._internal_lock:
+                self._draw_jobs.remove(job)
+                job._finish(exception)
+                self._internal_lock.notify_all()
+            if isinstance(exception, SystemExit):
+                # Fail-safe triggered, the worker ends along with the pending jobs
+                with self._internal_lock:
+                    self._draw_stopped = True
+                    while not self._draw_queue.empty():
+                        pending = self._draw_queue.get_nowait()
+                        self._draw_jobs.remove(pending)
+                        pending._finish(exception)
+                    self._internal_lock.notify_all()
+                return
 
     def show_image(self, image:cv2.typing.MatLike, title:str="Test Show Image"):
         cv2.imshow(title, image)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import select
+import threading
+import time
+from .utils.AnalyUtils import TestRT
+from .utils.Logger import Logger
+
+
+class AdaptivePoller:
+    """Paces the capture loop according to the game state, instead of a fixed tick.
+
+    The capture loop reports what it saw after every capture, and then waits for the next one:
+    - `ABSENT`: no question region is detected, the interval backs off exponentially up to `max_interval`;
+    - `IDLE`: the question is unchanged, the interval returns to `base_interval`;
+    - `DETECTED`: a new question is detected, the next capture happens immediately.
+    Calling `notify_draw_done` wakes up a waiting capture loop, and the next `tight_polls` waits use `min_interval`.
+    """
+
+    ABSENT = 'absent'
+    IDLE = 'idle'
+    DETECTED = 'detected'
+
+    def __init__(self, base_interval:float=0.01, min_interval:float=0.002, max_interval:float=0.5,
+                 backoff:float=2.0, tight_polls:int=10):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.tight_polls = tight_polls
+        self._interval = base_interval
+        self._tight_left = 0
+        self._wakeup = threading.Event()
+        self._decisions = {AdaptivePoller.ABSENT: 0, AdaptivePoller.IDLE: 0, AdaptivePoller.DETECTED: 0}
+        self.wakeups = 0
+        self.slept = 0.0
+        self._started_at = time.monotonic()
+        self._state:str = None
+        self._state_at = (self._started_at, time.process_time())
+        self._idle_wall = 0.0
+        self._idle_cpu = 0.0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def report(self, state:str):
+        """Reports the state seen by the last capture, which decides the next interval.
+
+        :param state: `ABSENT`, `IDLE` or `DETECTED`;
+        :rtype: None;
+        """
+        self._decisions[state] += 1
+        # The time until the next report is spent on waiting and capturing in the previous state
+        now = (time.monotonic(), time.process_time())
+        if self._state in (AdaptivePoller.ABSENT, AdaptivePoller.IDLE):
+            self._idle_wall += now[0] - self._state_at[0]
+            self._idle_cpu += now[1] - self._state_at[1]
+        self._state, self._state_at = state, now
+        if state == AdaptivePoller.DETECTED:
+            self._interval = 0
+        elif state == AdaptivePoller.ABSENT:
+            self._interval = min(self.max_interval, max(self._interval, self.base_interval) * self.backoff)
+        else:
+            self._interval = self.base_interval
+
+    def notify_draw_done(self):
+        """Signals that the drawing finished, so the next question is expected soon.
+
+        :rtype: None;
+        """
+        self._tight_left = self.tight_polls
+        self._wakeup.set()
+
+    def wait(self):
+        """Waits before the next capture, returning early if woken up.
+
+        :returns: `True` if woken up;
+        :rtype: bool;
+        """
+        interval = self._interval
+        if self._tight_left > 0:
+            self._tight_left -= 1
+            interval = min(interval, self.min_interval)
+        if interval <= 0:
+            return False
+        begin = time.perf_counter_ns()
+        woken = self._wakeup.wait(interval)
+        self._wakeup.clear()
+        span = time.perf_counter_ns() - begin
+        self.slept += span / 1e9
+        TestRT.record('poll_wait', span)
+        if woken:
+            self.wakeups += 1
+        return woken
+
+    def close(self):
+        """Releases the resources held by the poller.
+
+        :rtype: None;
+        """
+
+    def stats(self):
+        """Gets the decision counts, the capture rate against a fixed tick of `base_interval`,
+        the sleeping ratio of the capture loop and the CPU usage of the process while no new question is detected,
+        which is measured over the intervals following the `ABSENT` and `IDLE` reports.
+
+        :rtype: dict;
+        """
+        wall = time.monotonic() - self._started_at
+        return {
+            'decisions': dict(self._decisions),
+            'interval_ms': self._interval * 1000,
+            'wakeups': self.wakeups,
+            'wakeups_per_sec': self.wakeups / wall if wall > 0 else None,
+            'captures_per_sec': sum(self._decisions.values()) / wall if wall > 0 else None,
+            'baseline_captures_per_sec': 1 / self.base_interval if self.base_interval > 0 else None,
+            'sleep_ratio': self.slept / wall if wall > 0 else None,
+            'cpu_percent': self._idle_cpu * 100 / self._idle_wall if self._idle_wall > 0 else None
+        }
+
+
+class DamagePoller(AdaptivePoller):
+    """Paces the capture loop by the damage notifications of X11 (Linux only), instead of polling.
+
+    The XDamage extension reports the screen areas being repainted, and a listener thread wakes up the
+    capture loop only when a repainted area intersects the watched rectangle. A new question still makes
+    the next capture happen immediately, while an unchanged or absent question waits for the damage,
+    but at most `max_interval` seconds so that the expiring gates keep working.
+    """
+
+    def __init__(self, rect:tuple, base_interval:float=0.01, min_interval:float=0.002, max_interval:float=0.5,
+                 backoff:float=2.0, tight_polls:int=10):
+        super().__init__(base_interval, min_interval, max_interval, backoff, tight_polls)
+        from Xlib import display
+        from Xlib.ext import damage
+        self.rect = tuple(int(i) for i in rect) # (left, top, right, bottom)
+        self._display = display.Display()
+        if not self._display.has_extension('DAMAGE'):
+            self._display.close()
+            raise ImportError("XDamage extension is unavailable")
+        self._display.damage_query_version()
+        self._damage = self._display.screen().root.damage_create(damage.DamageReportDeltaRectangles)
+        self._display.flush()
+        self._notify = self._display.extension_event.DamageNotify
+        self.damage_events = 0
+        self.damage_hits = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._listen, name="DamagePoller", daemon=True)
+        self._thread.start()
+
+    def report(self, state:str):
+        super().report(state)
+        if state != AdaptivePoller.DETECTED:
+            # The damage wakes up the capture loop, so the interval is only a keep-alive
+            self._interval = self.max_interval
+
+    def close(self):
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._thread.join(1)
+        self._display.damage_destroy(self._damage)
+        self._display.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats['damage_events'] = self.damage_events
+        stats['damage_hits'] = self.damage_hits
+        return stats
+
+    def _intersects(self, area:object):
+        left, top, right, bottom = self.rect
+        return area.x < right and area.x + area.width > left and area.y < bottom and area.y + area.height > top
+
+    def _listen(self):
+        while not self._stop_event.is_set():
+            if not self._display.pending_events():
+                select.select([self._display], [], [], 0.1)
+                continue
+            hit = False
+            while self._display.pending_events():
+                event = self._display.next_event()
+                if event.type == self._notify:
+                    self.damage_events += 1
+                    hit = hit or self._intersects(event.area)
+            # Clears the reported damage, so that the next repaint is reported again
+            self._display.damage_subtract(self._damage)
+            self._display.flush()
+            if hit:
+                self.damage_hits += 1
+                self._wakeup.set()
+
+
+def create_poller(trigger:str="poll", rect:tuple=None, base_interval:float=0.01, max_interval:float=0.5):
+    """Creates the poller pacing a capture loop by the trigger name.
+
+    :param trigger: `"poll"` (adaptive polling) or `"damage"` (X11 damage notifications, falls back to adaptive polling);
+    :param rect: The watched screen rectangle in the format `(left, top, right, bottom)`, used by `"damage"`;
+    :param base_interval: The capture interval when the question is unchanged;
+    :param max_interval: The maximum capture interval;
+    :returns: The poller instance;
+    :rtype: AdaptivePoller;
+    """
+    if trigger == "damage":
+        try:
+            return DamagePoller(rect, base_interval, max_interval=max_interval)
+        except Exception as arg:
+            Logger.warn(f"Poller: XDamage is unavailable ({arg}), falling back to adaptive polling")
+    elif trigger != "poll":
+        raise ValueError(f"Unknown capture trigger '{trigger}'")
+    return AdaptivePoller(base_interval, max_interval=max_interval)
+
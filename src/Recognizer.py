@@ -3,8 +3,12 @@
 # @ MIT License
 import cv2
 import os
+import hashlib
+import threading
 import numpy as np
+from .GlyphCache import GlyphCache
 from .utils.AnalyUtils import TestRT
+from .utils.Assets import BUNDLE_PATH, LazyAsset, get_asset_path, is_bundle_fresh, load_bundle
 
 
 class MatchingResult:
@@ -20,6 +24,13 @@ class MatchingResult:
     def name(self):
         return self._name
 
+    @classmethod
+    def from_value(cls, confidence:float, name:str=""):
+        rst = cls.__new__(cls)
+        rst._min_val, rst._max_val, rst._min_loc, rst._max_loc = 0.0, confidence, (0, 0), (0, 0)
+        rst._name = name
+        return rst
+
     def validate(self, conf:float):
         return self._max_val >= conf
 
@@ -45,19 +56,359 @@ class TemplateSet:
                 if use_grayscale:
                     image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
                 self.data[label] = image
+        self._bank = None
+        self._packed = None
+
+    @classmethod
+    def from_images(cls, images:dict):
+        """Creates a template set from the given images directly.
+
+        :param images: A dict mapping the labels to the template images;
+        :returns: The template set;
+        :rtype: TemplateSet;
+        """
+        rst = cls.__new__(cls)
+        rst._data = dict(images)
+        rst._bank = None
+        rst._packed = None
+        return rst
+
+    @staticmethod
+    def load_chars():
+        """Loads the char templates, from the asset bundle if it is up to date.
+
+        :rtype: TemplateSet;
+        """
+        if is_bundle_fresh():
+            images = {k[6:]: v for k, v in load_bundle(BUNDLE_PATH).items() if k.startswith('chars/')}
+            if images:
+                return TemplateSet.from_images(images)
+        return TemplateSet(get_asset_path('templates', 'chars'), use_grayscale=True)
 
     @property
     def data(self):
         return self._data
 
+    @property
+    def fingerprint(self):
+        """The digest of all the templates in this set, used to invalidate derived data.
+
+        :rtype: str;
+        """
+        digest = hashlib.sha1()
+        for label in sorted(self._data.keys()):
+            image = self._data[label]
+            digest.update(f"{label}{image.shape}".encode())
+            digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @property
+    def bank(self):
+        """The compiled template bank of this set, which will be built on first access.
+
+        :rtype: TemplateBank;
+        """
+        if self._bank is None:
+            self._bank = TemplateBank(self)
+        return self._bank
+
+    @property
+    def packed(self):
+        """The bit-packed template table of this set, which will be built on first access.
+
+        :rtype: BitPackedBank;
+        """
+        if self._packed is None:
+            self._packed = BitPackedBank(self)
+        return self._packed
+
+
+class TemplateBank:
+    """Compiled form of a template set used for fast classification.
+
+    Every template is resampled to a few canonical glyph sizes. For each size, the templates are stored
+    as one contiguous float32 matrix whose rows are zero-mean and unit-norm, so scoring a glyph
+    against all templates is a single matrix-vector product giving the normalized correlation coefficients.
+
+    Before the correlation, a cascade compares cheap shape features of the glyph (see `features`) with those
+    of the templates. Only the `top_k` nearest templates are correlated, and only the nearest one is correlated
+    if it is close enough while all the others are far away. The confidence is always a correlation coefficient,
+    so a noisy glyph is rejected by the same threshold with or without the cascade.
+    """
+
+    BUCKETS = ((12, 16), (18, 24), (24, 32)) # (width, height)
+    # Tolerances of log aspect ratio, ink density, ink centroid (x, y) and ink spread (x, y)
+    FEATURE_SCALES = np.array([0.15, 0.06, 0.05, 0.05, 0.04, 0.04], dtype=np.float32)
+    HOLE_WEIGHT = 3.0
+    SKIP_DISTANCE = 2.0
+    SKIP_MARGIN = 4.0
+
+    def __init__(self, template_set:TemplateSet):
+        self._labels = list(template_set.data.keys())
+        self._stacks:"list[np.ndarray]" = []
+        for w, h in TemplateBank.BUCKETS:
+            stack = np.empty((len(self._labels), w * h), dtype=np.float32)
+            for i, label in enumerate(self._labels):
+                stack[i] = TemplateBank._resample(template_set.data[label], w, h)
+            self._stacks.append(TemplateBank._normalize_rows(stack))
+        features = [TemplateBank.features(template_set.data[label]) for label in self._labels]
+        self._features = np.array([f if f is not None else np.full(7, np.inf, dtype=np.float32) for f in features],
+                                  dtype=np.float32)
+        self.reset_stats()
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def score(self, image:cv2.typing.MatLike, candidates:np.ndarray=None):
+        """Scores the given glyph against the templates.
+
+        :param image: The single-channel glyph image;
+        :param candidates: The indices of the templates to score, `None` to score all templates;
+        :returns: The correlation coefficients in the order of `labels` (or `candidates`), all zeros if the glyph is blank;
+        :rtype: np.ndarray;
+        """
+        bucket = self._select_bucket(image.shape[0])
+        w, h = TemplateBank.BUCKETS[bucket]
+        stack = self._stacks[bucket] if candidates is None else self._stacks[bucket][candidates]
+        self.correlations += len(stack)
+        vector = TemplateBank._resample(image, w, h)
+        vector -= vector.mean()
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return np.zeros(len(stack), dtype=np.float32)
+        vector /= norm
+        return stack @ vector
+
+    def classify(self, image:cv2.typing.MatLike, top_k:int=0):
+        """Finds the best matched template of the given glyph.
+
+        :param image: The single-channel glyph image;
+        :param top_k: The count of the candidates kept by the feature cascade, `0` to disable the cascade;
+        :returns: A tuple of the label and the confidence;
+        :rtype: tuple;
+        """
+        self.glyphs += 1
+        feature = TemplateBank.features(image) if top_k > 0 else None
+        if feature is None:
+            scores = self.score(image)
+            idx = int(np.argmax(scores))
+            return self._labels[idx], float(scores[idx])
+        distances = self.feature_distances(feature)
+        order = np.argsort(distances)
+        best = float(distances[order[0]])
+        if best <= TemplateBank.SKIP_DISTANCE and \
+                (len(order) == 1 or float(distances[order[1]]) >= best + TemplateBank.SKIP_MARGIN):
+            # A single confident candidate, which is still correlated to get a comparable confidence
+            self.skipped += 1
+            candidates = order[:1]
+        else:
+            candidates = order[:top_k]
+        scores = self.score(image, candidates)
+        idx = int(np.argmax(scores))
+        return self._labels[int(candidates[idx])], float(scores[idx])
+
+    def feature_distances(self, feature:np.ndarray):
+        """Computes the weighted feature distances between the given glyph and all templates.
+
+        :param feature: The features returned by `features`;
+        :returns: The distances in the order of `labels`;
+        :rtype: np.ndarray;
+        """
+        diff = np.abs(self._features - feature)
+        return (diff[:, :6] / TemplateBank.FEATURE_SCALES).sum(axis=1) + diff[:, 6] * TemplateBank.HOLE_WEIGHT
+
+    @staticmethod
+    def features(image:cv2.typing.MatLike):
+        """Computes the cheap shape features of the ink inside the given glyph image: log aspect ratio,
+        ink density, ink centroid (x, y), ink spread (x, y) and hole count.
+
+        :param image: The single-channel glyph image;
+        :returns: The features, `None` if the glyph is blank;
+        :rtype: np.ndarray|None;
+        """
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        ink = image < 128
+        cols = np.flatnonzero(ink.any(axis=0))
+        rows = np.flatnonzero(ink.any(axis=1))
+        if not len(cols):
+            return None
+        ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        h, w = ink.shape
+        col_sum = ink.sum(axis=0, dtype=np.float32)
+        row_sum = ink.sum(axis=1, dtype=np.float32)
+        total = col_sum.sum()
+        xs = np.arange(w, dtype=np.float32) / max(w - 1, 1)
+        ys = np.arange(h, dtype=np.float32) / max(h - 1, 1)
+        cx = float(col_sum @ xs) / total
+        cy = float(row_sum @ ys) / total
+        sx = float(np.sqrt(max(float(col_sum @ (xs * xs)) / total - cx * cx, 0)))
+        sy = float(np.sqrt(max(float(row_sum @ (ys * ys)) / total - cy * cy, 0)))
+        # Holes are the background components not connected to the padded border
+        background = np.pad((~ink).view(np.uint8), 1, constant_values=1)
+        holes = cv2.connectedComponents(background, connectivity=4)[0] - 2
+        return np.array([np.log(w / h), total / (w * h), cx, cy, sx, sy, holes], dtype=np.float32)
+
+    def reset_stats(self):
+        self.glyphs = 0
+        self.skipped = 0
+        self.correlations = 0
+
+    def stats(self):
+        """Gets the pruning statistics of the feature cascade.
+
+        :rtype: dict;
+        """
+        full = self.glyphs * len(self._labels)
+        return {
+            'glyphs': self.glyphs,
+            'skipped': self.skipped,
+            'skip_rate': self.skipped / self.glyphs if self.glyphs else None,
+            'templates_per_glyph': self.correlations / self.glyphs if self.glyphs else None,
+            'pruning_rate': 1 - self.correlations / full if full else None
+        }
+
+    @staticmethod
+    def _select_bucket(height:int):
+        return min(range(len(TemplateBank.BUCKETS)), key=lambda i:abs(TemplateBank.BUCKETS[i][1] - height))
+
+    @staticmethod
+    def _resample(image:cv2.typing.MatLike, w:int, h:int):
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        interpolation = cv2.INTER_AREA if image.shape[0] > h else cv2.INTER_LINEAR
+        return cv2.resize(image, (w, h), interpolation=interpolation).astype(np.float32).ravel()
+
+    @staticmethod
+    def _normalize_rows(stack:np.ndarray):
+        stack -= stack.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(stack, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        stack /= norm
+        return np.ascontiguousarray(stack)
+
+
+class BitPackedBank:
+    """Compiled form of a template set used for the bit-packed classification.
+
+    Every template is binarized on a `GRID_SIZE` grid and packed into bytes. A glyph packed in the same way
+    is classified by its Hamming distance to each template, computed by XOR and a popcount lookup table,
+    which is much cheaper than the correlation but suits only crisp renders.
+    """
+
+    GRID_SIZE = GlyphCache.GRID_SIZE
+    BINARY_THRESHOLD = GlyphCache.BINARY_THRESHOLD
+    _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def __init__(self, template_set:TemplateSet):
+        self._labels = list(template_set.data.keys())
+        self._table = np.stack([BitPackedBank.pack(template_set.data[label]) for label in self._labels])
+        self._bits = BitPackedBank.GRID_SIZE[0] * BitPackedBank.GRID_SIZE[1]
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def distances(self, image:cv2.typing.MatLike):
+        """Computes the Hamming distances between the given glyph and all templates.
+
+        :param image: The single-channel glyph image;
+        :returns: The distances in the order of `labels`;
+        :rtype: np.ndarray;
+        """
+        return self._hamming(BitPackedBank.pack(image))
+
+    def classify(self, image:cv2.typing.MatLike, top_k:int=0):
+        """Finds the nearest template of the given glyph.
+
+        :param image: The single-channel glyph image;
+        :param top_k: Unused, for the compatibility with `TemplateBank.classify`;
+        :returns: A tuple of the label and the confidence, which is `1` for identical bits and `0` for a blank glyph;
+        :rtype: tuple;
+        """
+        packed = BitPackedBank.pack(image)
+        distances = self._hamming(packed)
+        idx = int(np.argmin(distances))
+        if not packed.any():
+            return self._labels[idx], 0.0
+        # Half of the bits differ between two unrelated glyphs on average
+        return self._labels[idx], 1 - 2 * int(distances[idx]) / self._bits
+
+    def _hamming(self, packed:np.ndarray):
+        return BitPackedBank._POPCOUNT[np.bitwise_xor(self._table, packed)].sum(axis=1, dtype=np.int32)
+
+    @staticmethod
+    def pack(image:cv2.typing.MatLike):
+        """Binarizes the given glyph on the grid and packs the ink bits.
+
+        :param image: The glyph image;
+        :returns: The packed bits;
+        :rtype: np.ndarray;
+        """
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        grid = cv2.resize(image, BitPackedBank.GRID_SIZE, interpolation=cv2.INTER_AREA)
+        return np.packbits(grid < BitPackedBank.BINARY_THRESHOLD)
+
 
 class Recognizer:
-    T_CHARS = TemplateSet('assets/templates/chars', use_grayscale=True)
+    T_CHARS:TemplateSet = LazyAsset(TemplateSet.load_chars)
+    # Engine name -> the property of `TemplateSet` giving the classifier
+    ENGINES = {"opencv": "bank", "bitpacked": "packed"}
     T_THRESHOLD = 0.5
+    CASCADE_TOP_K = 0 # The feature cascade pays off only with large template sets
     S_THRESHOLD = 255
 
-    def __init__(self):
-        pass
+    def __init__(self, glyph_cache:GlyphCache=None, engine:str="opencv"):
+        if engine not in Recognizer.ENGINES:
+            raise ValueError(f"Unknown recognizer engine '{engine}'")
+        self._glyph_cache = glyph_cache
+        self._engine = engine
+        self._local = threading.local()
+
+    @property
+    def glyph_cache(self):
+        return self._glyph_cache
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def fingerprint(self):
+        """The fingerprint of the recognition results, which covers the templates, the engine and the threshold,
+        since the confidences of the engines are on different scales.
+
+        :rtype: str;
+        """
+        return f"{Recognizer.T_CHARS.fingerprint}-{self._engine}-{Recognizer.T_THRESHOLD}"
+
+    def classifier(self, template_set:TemplateSet):
+        """Gets the classifier of the given template set for the engine of this recognizer.
+
+        :param template_set: The template set;
+        :returns: The classifier, which has the method `classify(image, top_k)`;
+        :rtype: TemplateBank|BitPackedBank;
+        """
+        return getattr(template_set, Recognizer.ENGINES[self._engine])
+
+    def frame_buffer(self, shape:tuple):
+        """Gets the reusable single-channel buffer of the given shape, which is owned by the calling thread.
+        The buffer will be overwritten by the next preprocessing on the same thread.
+
+        :param shape: The shape in the format `(height, width)`;
+        :returns: The buffer;
+        :rtype: np.ndarray;
+        """
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buffer = buffers.get(shape, None)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=np.uint8)
+            buffers[shape] = buffer
+        return buffer
 
     def match(self, image:cv2.typing.MatLike, template:cv2.typing.MatLike, name:str=""):
         rst = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
@@ -71,65 +422,95 @@ class Recognizer:
         return self.match(image, template, name)
 
     def best_match(self, image:cv2.typing.MatLike, template_set:TemplateSet, min_confidence:float=None):
-        rst = max((self.safe_match(image, v, k) for k, v in template_set.data.items()), key=lambda x:x.confidence)
+        if image.size == 0:
+            return None
+        label, confidence = self.classifier(template_set).classify(image, Recognizer.CASCADE_TOP_K)
+        rst = MatchingResult.from_value(confidence, label)
         return rst if min_confidence is None or rst.confidence >= min_confidence else None
 
     def recognize(self, image:cv2.typing.MatLike):
-        return self._recognize_opencv(image)
+        return self._recognize(image)
+
+    def _recognize(self, image:cv2.typing.MatLike, template_set:TemplateSet=None):
+        with TestRT(f"recognize_{self._engine}"):
+            image = self.preprocess(image, self.frame_buffer(image.shape[:2]))
+            return self.recognize_boxes(image, self.char_boxes(image), template_set)
+
+    def recognize_boxes(self, image:cv2.typing.MatLike, boxes:list, template_set:TemplateSet=None):
+        """Recognizes the glyphs in the given boxes of the preprocessed image and joins the labels.
+
+        :param image: The preprocessed single-channel image;
+        :param boxes: The boxes returned by `char_boxes`;
+        :param template_set: The templates to match, defaults to `T_CHARS`;
+        :returns: The recognized string;
+        :rtype: str;
+        """
+        template_set = template_set or Recognizer.T_CHARS
+        recognized = ""
+        for x0, x1, y0, y1 in boxes:
+            recognized += self._recognize_glyph(image[y0:y1, x0:x1], template_set)
+        return recognized
 
-    def _recognize_opencv(self, image:cv2.typing.MatLike, template_set:TemplateSet=T_CHARS):
-        with TestRT("recognize_opencv"):
-            segmented = self.char_segmentation(image)
-            recognized = ""
-            for seg_image in segmented:
-                if result := self.best_match(seg_image, template_set, Recognizer.T_THRESHOLD):
-                    recognized += result.name
-            return recognized
+    def _recognize_glyph(self, image:cv2.typing.MatLike, template_set:TemplateSet):
+        if self._glyph_cache is None:
+            result = self.best_match(image, template_set, Recognizer.T_THRESHOLD)
+            return result.name if result else ""
+        key = GlyphCache.signature(image)
+        cached = self._glyph_cache.get(key)
+        if cached is not None:
+            return cached[0]
+        result = self.best_match(image, template_set)
+        if result:
+            label = result.name if result.confidence >= Recognizer.T_THRESHOLD else ""
+            self._glyph_cache.put(key, label, result.confidence)
+            return label
+        return ""
 
     @staticmethod
-    def char_segmentation(image:cv2.typing.MatLike):
-        # Preprocess
+    def preprocess(image:cv2.typing.MatLike, dst:np.ndarray=None):
+        """Enhances the contrast of the given image and converts it to a single-channel image.
+
+        :param image: The captured image, which is left unchanged;
+        :param dst: The single-channel uint8 buffer to write the result in place, `None` to allocate a new image;
+        :returns: The preprocessed image, which is `dst` if given;
+        :rtype: np.ndarray;
+        """
         if len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
         if len(image.shape) != 2:
             raise RuntimeError("Image must have exactly one tunnel")
-        image = cv2.convertScaleAbs(image, alpha=1.75, beta=-32.0)
-        image = cv2.normalize(image, None, alpha=-32, beta=255, norm_type=cv2.NORM_MINMAX)
-        image = np.clip(image, 0, 255)
+        image = cv2.convertScaleAbs(image, dst, alpha=1.75, beta=-32.0)
+        # The uint8 output saturates the stretched range, so no clipping is needed
+        return cv2.normalize(image, image, alpha=-32, beta=255, norm_type=cv2.NORM_MINMAX)
+
+    @staticmethod
+    def char_boxes(image:cv2.typing.MatLike):
+        """Finds the bounding boxes of the chars in the given preprocessed image.
+        The image is split by its column projection first, then each slice is split by the row projection.
 
-        # Generate histogram
+        :param image: The preprocessed single-channel image;
+        :returns: A list of boxes in the format `(x0, x1, y0, y1)`;
+        :rtype: list;
+        """
         h, w = image.shape
-        vertical_avg = np.zeros((h, 1), dtype=image.dtype)
-        horizontal_avg = np.zeros((w, 1), dtype=image.dtype)
-        for y in range(h):
-            vertical_avg[y] = np.average(image[y, :])
-        for x in range(w):
-            horizontal_avg[x] = np.average(image[:, x])
-
-        # Do segmentation
-        def _one_dimension_seg(_image, _histogram, _is_y):
-            _h, _w = _image.shape
-            _char_images = []
-            _idx0 = None
-            for i in range(_h if _is_y else _w):
-                if _histogram[i] < Recognizer.S_THRESHOLD and _idx0 is None:
-                    _idx0 = i
-                elif _histogram[i] >= Recognizer.S_THRESHOLD and _idx0 is not None:
-                    _idx1 = i
-                    _char_image = _image[_idx0:_idx1, :] if _is_y else _image[:, _idx0:_idx1]
-                    if _char_image.size > 1:
-                        _char_images.append(_char_image)
-                    _idx0 = None
-            if _idx0 is not None:
-                _idx1 = i
-                _char_image = _image[_idx0:_idx1, :] if _is_y else _image[:, _idx0:_idx1]
-                if _char_image.size > 1:
-                    _char_images.append(_char_image)
-            return _char_images
-
-        # Horizontal splitting first, then vertical splitting
-        temp = _one_dimension_seg(image, horizontal_avg, False)
-        char_images = []
-        for t in temp:
-            char_images.extend(_one_dimension_seg(t, vertical_avg, True))
-        return char_images
+        # The mean of a uint8 line is below 255 exactly when its minimum is
+        cols = Recognizer._projection_runs(image.min(axis=0) < Recognizer.S_THRESHOLD)
+        rows = Recognizer._projection_runs(image.min(axis=1) < Recognizer.S_THRESHOLD)
+        return [(x0, x1, y0, y1)
+                for x0, x1 in cols if h * (x1 - x0) > 1
+                for y0, y1 in rows if (x1 - x0) * (y1 - y0) > 1]
+
+    @staticmethod
+    def _projection_runs(mask:np.ndarray):
+        n = len(mask)
+        edges = np.flatnonzero(np.diff(mask.astype(np.int8), prepend=0, append=0))
+        starts, ends = edges[0::2].tolist(), edges[1::2].tolist()
+        if ends and ends[-1] == n:
+            # A run reaching the end excludes the last index
+            ends[-1] = n - 1
+        return list(zip(starts, ends))
+
+    @staticmethod
+    def char_segmentation(image:cv2.typing.MatLike):
+        image = Recognizer.preprocess(image)
+        return [image[y0:y1, x0:x1] for x0, x1, y0, y1 in Recognizer.char_boxes(image)]
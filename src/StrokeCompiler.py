@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+from functools import lru_cache
+
+
+class StrokeCompiler:
+    """Compiler that turns an answer string into a flat list of pointer events in absolute screen coordinates.
+
+    Every event is a tuple `(op, x, y)`, where `op` is one of `EV_DOWN`, `EV_MOVE` and `EV_UP`.
+    Duplicated and collinear points are dropped, and an `EV_UP` reuses the current pen position
+    instead of moving again. Compiled answers are memoized per `(answer, region)`,
+    and so are the single chars compiled for streaming per `(char, cell)`.
+    """
+
+    EV_DOWN = 0
+    EV_MOVE = 1
+    EV_UP = 2
+
+    def __init__(self, strokes:dict, cache_size:int=256):
+        self._strokes = strokes
+        self.compile = lru_cache(maxsize=cache_size)(self._compile)
+        self.compile_char = lru_cache(maxsize=cache_size)(self._compile_char)
+
+    def _compile(self, answer:str, left_top:tuple, right_bottom:tuple):
+        """Compiles the answer to be written evenly across the given region.
+
+        :param answer: The answer string;
+        :param left_top: The left-top corner of the answering region;
+        :param right_bottom: The right-bottom corner of the answering region;
+        :returns: The events;
+        :rtype: tuple;
+        """
+        if not answer:
+            raise ValueError("Argument answer is empty or none")
+        w_per_char = (right_bottom[0] - left_top[0]) // len(answer)
+        events = []
+        cur_x = left_top[0]
+        for i in answer:
+            events.extend(self._compile_char(i, (cur_x, left_top[1]), (cur_x + w_per_char, right_bottom[1])))
+            cur_x += w_per_char
+        return tuple(events)
+
+    def _compile_char(self, char:str, left_top:tuple, right_bottom:tuple):
+        """Compiles a single char to be written in the given cell.
+
+        :param char: The char;
+        :param left_top: The left-top corner of the cell;
+        :param right_bottom: The right-bottom corner of the cell;
+        :returns: The events;
+        :rtype: tuple;
+        """
+        if char not in self._strokes:
+            raise ValueError(f"Char '{char}' is not in strokes dict")
+        return tuple(self.compile_strokes(left_top, right_bottom, self._strokes[char]))
+
+    @staticmethod
+    def compile_strokes(left_top:tuple, right_bottom:tuple, strokes:list):
+        """Compiles a single stroke given in relative coordinates of the region.
+
+        :param left_top: The left-top corner of the region;
+        :param right_bottom: The right-bottom corner of the region;
+        :param strokes: The points of the stroke, each coordinate ranges from 0 to 1;
+        :returns: The events;
+        :rtype: list;
+        """
+        width = right_bottom[0] - left_top[0]
+        height = right_bottom[1] - left_top[1]
+        points = StrokeCompiler.simplify([(int(x * width + left_top[0]), int(y * height + left_top[1])) for x, y in strokes])
+        if not points:
+            return []
+        events = [(StrokeCompiler.EV_DOWN, *points[0])]
+        events.extend((StrokeCompiler.EV_MOVE, x, y) for x, y in points[1:])
+        events.append((StrokeCompiler.EV_UP, *points[-1]))
+        return events
+
+    @staticmethod
+    def simplify(points:list):
+        """Drops the duplicated points and the points lying on the segment between their neighbors.
+
+        :param points: The list of integer points;
+        :returns: The simplified list;
+        :rtype: list;
+        """
+        rst = []
+        for p in points:
+            if rst and rst[-1] == p:
+                continue
+            if len(rst) >= 2:
+                (ax, ay), (bx, by) = rst[-2], rst[-1]
+                cross = (bx - ax) * (p[1] - by) - (by - ay) * (p[0] - bx)
+                dot = (bx - ax) * (p[0] - bx) + (by - ay) * (p[1] - by)
+                if cross == 0 and dot > 0:
+                    rst[-1] = p
+                    continue
+            rst.append(p)
+        return rst
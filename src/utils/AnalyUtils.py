@@ -1,9 +1,118 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2024, Harry Huang
 # @ MIT License
+import json
+import os
+import threading
 import time
 from contextlib import ContextDecorator
-from collections import defaultdict
+
+
+class LatencyHistogram:
+    """Fixed-memory histogram of nanosecond spans with log-linear buckets (HDR-style).
+
+    Values below `SUB_BUCKETS` are counted exactly, and every power of two above is split into
+    `SUB_BUCKETS` linear buckets, so the relative error of the percentiles is at most `1 / SUB_BUCKETS`.
+    """
+
+    SUB_BUCKETS = 16
+    _SUB_BITS = 4
+    _BUCKETS = (64 - _SUB_BITS + 1) * SUB_BUCKETS
+
+    def __init__(self):
+        self._counts = [0] * LatencyHistogram._BUCKETS
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.first_at = None
+        self.last_at = None
+
+    @staticmethod
+    def _index(value:int):
+        if value < LatencyHistogram.SUB_BUCKETS:
+            return value
+        exp = value.bit_length() - 1
+        mantissa = value >> (exp - LatencyHistogram._SUB_BITS)
+        return (exp - LatencyHistogram._SUB_BITS + 1) * LatencyHistogram.SUB_BUCKETS + mantissa - LatencyHistogram.SUB_BUCKETS
+
+    @staticmethod
+    def _bucket_range(index:int):
+        if index < LatencyHistogram.SUB_BUCKETS:
+            return (index, index + 1)
+        exp = index // LatencyHistogram.SUB_BUCKETS + LatencyHistogram._SUB_BITS - 1
+        mantissa = index % LatencyHistogram.SUB_BUCKETS + LatencyHistogram.SUB_BUCKETS
+        shift = exp - LatencyHistogram._SUB_BITS
+        return (mantissa << shift, (mantissa + 1) << shift)
+
+    def record(self, value:int):
+        """Records a span.
+
+        :param value: The span in nanoseconds;
+        :rtype: None;
+        """
+        value = max(0, int(value))
+        now = time.monotonic()
+        with self._lock:
+            self._counts[LatencyHistogram._index(value)] += 1
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            if self.first_at is None:
+                self.first_at = now
+            self.last_at = now
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p:float):
+        """Gets the approximate percentile of the recorded spans.
+
+        :param p: The percentage, ranging from 0 to 100;
+        :returns: The span in nanoseconds, `None` if nothing has been recorded;
+        :rtype: float|None;
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, int(round(p / 100 * self.count)))
+            seen = 0
+            for i, c in enumerate(self._counts):
+                seen += c
+                if seen >= rank:
+                    low, high = LatencyHistogram._bucket_range(i)
+                    return min(max((low + high - 1) / 2, self.min), self.max)
+            return self.max
+
+    def rate(self):
+        """Gets the recording rate between the first and the last record.
+
+        :returns: The count of records per second, `None` if there are not enough records;
+        :rtype: float|None;
+        """
+        if self.count < 2 or self.last_at == self.first_at:
+            return None
+        return (self.count - 1) / (self.last_at - self.first_at)
+
+    def summary(self):
+        """Gets the statistics of this histogram in milliseconds.
+
+        :rtype: dict;
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.mean / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p95_ms': self.percentile(95) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'max_ms': self.max / 1e6,
+            'rate_per_sec': self.rate()
+        }
 
 
 class TestRT(ContextDecorator):
@@ -14,28 +123,130 @@ class TestRT(ContextDecorator):
         pass # The codes to test
     print(TestRT.get_avg_time('scope'))
     ```
+
+    Every scope is recorded into a fixed-memory `LatencyHistogram` using `time.perf_counter_ns`.
+    Set `TestRT.enabled` to `False` to turn the recording into a no-op.
     """
 
-    _records = defaultdict(list)
+    enabled = True
+    _records:"dict[str,LatencyHistogram]" = {}
+    _records_lock = threading.Lock()
+    _exporter:threading.Thread = None
+    _exporter_stop = threading.Event()
 
     def __init__(self, name):
         self.name = name
         self.start_time = None
 
     def __enter__(self):
-        self.start_time = time.time()
+        if TestRT.enabled:
+            self.start_time = time.perf_counter_ns()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        span = time.time() - self.start_time
-        TestRT._records[self.name].append(span)
+        if self.start_time is not None:
+            TestRT.record(self.name, time.perf_counter_ns() - self.start_time)
+            self.start_time = None
         return False
 
+    @staticmethod
+    def record(name:str, span_ns:int):
+        """Records a span measured elsewhere into the given scope.
+
+        :param name: The name of the scope;
+        :param span_ns: The span in nanoseconds;
+        :rtype: None;
+        """
+        if not TestRT.enabled:
+            return
+        histogram = TestRT._records.get(name, None)
+        if histogram is None:
+            with TestRT._records_lock:
+                histogram = TestRT._records.setdefault(name, LatencyHistogram())
+        histogram.record(span_ns)
+
+    @staticmethod
+    def get_histogram(name):
+        return TestRT._records.get(name, None)
+
     @staticmethod
     def get_avg_time(name):
-        times = TestRT._records.get(name, None)
-        return sum(times) / len(times) if times else None
+        histogram = TestRT._records.get(name, None)
+        return histogram.mean / 1e9 if histogram and histogram.count else None
 
     @staticmethod
     def get_avg_time_all():
-        return {k: sum(v) / len(v) for k, v in TestRT._records.items()}
+        return {k: v.mean / 1e9 for k, v in list(TestRT._records.items()) if v.count}
+
+    @staticmethod
+    def get_percentile(name, p:float):
+        """Gets the approximate percentile of the running time of the given scope in seconds."""
+        histogram = TestRT._records.get(name, None)
+        value = histogram.percentile(p) if histogram else None
+        return value / 1e9 if value is not None else None
+
+    @staticmethod
+    def snapshot():
+        """Gets the statistics of all the scopes.
+
+        :returns: A dict mapping the scope names to their summaries;
+        :rtype: dict;
+        """
+        return {k: v.summary() for k, v in list(TestRT._records.items())}
+
+    @staticmethod
+    def reset():
+        with TestRT._records_lock:
+            TestRT._records.clear()
+
+    @staticmethod
+    def export_json_lines(file_path:str):
+        """Appends the current snapshot as a JSON line to the given file."""
+        with open(file_path, 'a', encoding='UTF-8') as f:
+            f.write(json.dumps({'time': time.time(), 'scopes': TestRT.snapshot()}) + '\n')
+
+    @staticmethod
+    def export_prometheus(file_path:str):
+        """Writes the current snapshot to the given file in the Prometheus text exposition format."""
+        lines = ["# TYPE autoxyks_span_seconds summary"]
+        for k, v in list(TestRT._records.items()):
+            if not v.count:
+                continue
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f"autoxyks_span_seconds{{scope=\"{k}\",quantile=\"{q}\"}} {v.percentile(q * 100) / 1e9:.9f}")
+            lines.append(f"autoxyks_span_seconds_sum{{scope=\"{k}\"}} {v.total / 1e9:.9f}")
+            lines.append(f"autoxyks_span_seconds_count{{scope=\"{k}\"}} {v.count}")
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, file_path)
+
+    @staticmethod
+    def start_exporter(file_path:str, interval:float=10):
+        """Starts a daemon thread that exports the snapshot periodically.
+        The Prometheus format is used if the file extension is `.prom`, otherwise JSON lines are used.
+
+        :param file_path: The path to the export file;
+        :param interval: The seconds between two exports;
+        :rtype: None;
+        """
+        TestRT.stop_exporter()
+        export = TestRT.export_prometheus if file_path.endswith('.prom') else TestRT.export_json_lines
+        def _loop():
+            while not TestRT._exporter_stop.wait(interval):
+                try:
+                    export(file_path)
+                except Exception:
+                    pass
+            export(file_path)
+        TestRT._exporter_stop.clear()
+        TestRT._exporter = threading.Thread(name="TestRTExporter", target=_loop, daemon=True)
+        TestRT._exporter.start()
+
+    @staticmethod
+    def stop_exporter():
+        """Stops the exporter thread after a final export."""
+        if TestRT._exporter:
+            TestRT._exporter_stop.set()
+            TestRT._exporter.join()
+            TestRT._exporter = None
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import os
+import os.path as osp
+import struct
+import sys
+import threading
+import zipfile
+from typing import Callable
+
+# The project root, or the bundle directory of a PyInstaller build
+ROOT_DIR = getattr(sys, '_MEIPASS', osp.dirname(osp.dirname(osp.dirname(osp.abspath(__file__)))))
+ASSETS_DIR = osp.join(ROOT_DIR, 'assets')
+BUNDLE_PATH = osp.join(ASSETS_DIR, 'bundle.npz')
+
+
+def get_asset_path(*parts:str):
+    """Gets the absolute path of an asset, which is independent of the working directory.
+
+    :param parts: The path components relative to the assets directory;
+    :returns: The absolute path;
+    :rtype: str;
+    """
+    return osp.join(ASSETS_DIR, *parts)
+
+
+class LazyAsset:
+    """Descriptor of a class attribute whose value is loaded on first access, in a thread-safe way."""
+
+    def __init__(self, loader:Callable):
+        self._loader = loader
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __get__(self, obj, owner):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._loader()
+        return self._value
+
+
+def save_bundle(file_path:str, arrays:dict):
+    """Saves the arrays to an uncompressed `.npz` bundle, whose members can be memory-mapped.
+
+    :param file_path: The path to the bundle;
+    :param arrays: A dict mapping the member names to the arrays;
+    :rtype: None;
+    """
+    import numpy as np
+    temp_path = file_path + '.tmp.npz'
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, file_path)
+
+
+def load_bundle(file_path:str):
+    """Loads an uncompressed `.npz` bundle, memory-mapping every member instead of reading it.
+    Compressed members are read normally.
+
+    :param file_path: The path to the bundle;
+    :returns: A dict mapping the member names to the arrays;
+    :rtype: dict;
+    """
+    import numpy as np
+    arrays = {}
+    with zipfile.ZipFile(file_path) as zf, open(file_path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # Skip the local file header to locate the raw .npy data
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or 0 in shape:
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+def is_bundle_fresh(file_path:str=BUNDLE_PATH):
+    """Checks whether the bundle exists and is newer than all the other assets."""
+    if not osp.isfile(file_path):
+        return False
+    bundle_time = osp.getmtime(file_path)
+    for root, _, files in os.walk(ASSETS_DIR):
+        for i in files:
+            path = osp.join(root, i)
+            if osp.abspath(path) != osp.abspath(file_path) and osp.getmtime(path) > bundle_time:
+                return False
+    return True
+
+
+def build_bundle(file_path:str=BUNDLE_PATH):
+    """Builds the asset bundle containing the grayscale char templates (`chars/<label>`)
+    and the stroke arrays (`strokes/<char>`).
+
+    :param file_path: The path to the bundle;
+    :returns: The count of bundled arrays;
+    :rtype: int;
+    """
+    import cv2
+    import json
+    import numpy as np
+    arrays = {}
+    chars_dir = get_asset_path('templates', 'chars')
+    for i in sorted(os.listdir(chars_dir)):
+        label, ext = osp.splitext(i)
+        if ext.lower() in ('.png', '.jpg'):
+            image = cv2.imread(osp.join(chars_dir, i), cv2.IMREAD_COLOR)
+            arrays[f"chars/{label}"] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    with open(get_asset_path('strokes.json'), 'r', encoding='UTF-8') as f:
+        for k, v in json.load(f).items():
+            arrays[f"strokes/{k}"] = np.array(v, dtype=np.float32).reshape(-1, 2)
+    save_bundle(file_path, arrays)
+    return len(arrays)
+
+
+if __name__ == '__main__':
+    print(f"Bundled {build_bundle()} arrays into {BUNDLE_PATH}")
@@ -38,7 +38,23 @@ class Config():
     __default_config = {
         'log_file': "AutoXYKS.log",
         'log_level': Logger.LV_INFO,
-        'region': [[665, 55], [1210, 1010]]
+        'region': [[665, 55], [1210, 1010]],
+        'regions': [],
+        'performance_level': PerformanceLevel.STANDARD,
+        'ocr_mode': "inline",
+        'recognizer_engine': "opencv",
+        'answer_expire_time': 2.5,
+        'poll_max_interval': 0.5,
+        'stream_draw': False,
+        'capture_trigger': "poll",
+        'calibrate_every': 0,
+        'capture_backend': "auto",
+        'input_backend': "pyautogui",
+        'input_event_interval': None,
+        'glyph_cache_size': 1024,
+        'glyph_cache_file': "AutoXYKS.glyphs.json",
+        'metrics_file': "",
+        'metrics_interval': 10
     }
 
     def __init__(self):
@@ -48,6 +64,11 @@ class Config():
     def _get(self, key):
         return self.config.get(key, None)
 
+    def _set(self, key, value):
+        if key not in Config.__default_config:
+            raise KeyError(f"Unknown config field '{key}'")
+        self.config[key] = value
+
     def _read_config(self):
         if osp.isfile(Config.__config_path):
             try:
@@ -60,12 +81,12 @@ class Config():
                 Logger.set_level(self.get('log_level'))
                 Logger.info("Config: Applied config.")
             except Exception as arg:
-                self.config = Config.__default_config
+                self.config = dict(Config.__default_config)
                 Logger.set_instance(self.get('log_file'), self.get('log_level'))
                 Logger.set_level(self.get('log_level'))
                 Logger.error(f"Config: Failed to parsing config, now using default config, cause: {arg}")
         else:
-            self.config = Config.__default_config
+            self.config = dict(Config.__default_config)
             Logger.set_instance(self.get('log_file'), self.get('log_level'))
             Logger.set_level(self.get('log_level'))
             Logger.info("Config: Applied default config.")
@@ -95,6 +116,16 @@ class Config():
         """
         return Config._get_instance()._get(key)
 
+    @staticmethod
+    def set(key, value):
+        """Sets the specified config field. Use `save_config` to make it persistent.
+
+        :param key: The JSON key to the field;
+        :param value: The new value of the field;
+        :rtype: None;
+        """
+        return Config._get_instance()._set(key, value)
+
     @staticmethod
     def read_config():
         """Reads the config from file, aka. deserialize the config.
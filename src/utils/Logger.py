@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2024, Harry Huang
 # @ MIT License
+import atexit
+import os
 import threading
+import time
+from collections import deque
 from datetime import datetime
 
 
 class Logger():
-    """Logger class for AuoXYKS"""
+    """Logger class for AuoXYKS.
+
+    Log lines are handed off to a writer thread through a deque, so the callers never wait for console or disk I/O.
+    The writer keeps the log file open, flushes it in batches and rotates it by size.
+    Under backpressure, DEBUG lines are dropped first, and all lines except ERROR are dropped when the queue is full.
+    """
 
     __time_format   = '%Y-%m-%d %H:%M:%S'
     __file_encoding = 'UTF-8'
@@ -17,41 +26,118 @@ class Logger():
     LV_INFO     = 3
     LV_DEBUG    = 4
 
+    QUEUE_SOFT_LIMIT = 1024
+    QUEUE_HARD_LIMIT = 8192
+    FLUSH_LINES = 64
+    FLUSH_INTERVAL = 1.0
+    ROTATE_BYTES = 4 * 1024 * 1024
+    ROTATE_BACKUPS = 2
+
     def __init__(self, log_file_path:str, level:int):
         """Not recommended to use. Please use the singleton instance."""
         self.log_level = level
         self.log_file_path = log_file_path
-        self.internal_lock = threading.Condition()
         self.file = None
-        self.queue = []
-        def loop(self:Logger):
-            while True:
-                try:
-                    with self.internal_lock:
-                        while not self.queue:
-                            self.internal_lock.wait()
-                        t = self.queue.pop(0)
-                        if isinstance(self.log_file_path, str) and len(self.log_file_path) > 0:
-                            with open(self.log_file_path, 'a', encoding=Logger.__file_encoding) as f:
-                                f.write(t)
-                except BaseException:
-                    pass
-        self.thread = threading.Thread(name=self.__class__.__name__, target=loop, args=(self,), daemon=True)
+        self.queue = deque()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self._wakeup = threading.Event()
+        self._io_lock = threading.Lock()
+        self._closed = False
+        self.thread = threading.Thread(name=self.__class__.__name__, target=self._loop, daemon=True)
         self.thread.start()
+        atexit.register(self._close)
+
+    def _loop(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            self._wakeup.wait(Logger.FLUSH_INTERVAL)
+            self._wakeup.clear()
+            with self._io_lock:
+                if self._closed:
+                    # The closing thread writes the rest
+                    return
+                pending += self._drain()
+                if pending and (pending >= Logger.FLUSH_LINES or time.monotonic() - last_flush >= Logger.FLUSH_INTERVAL):
+                    self._flush()
+                    pending = 0
+                    last_flush = time.monotonic()
+
+    def _drain(self):
+        count = 0
+        while self.queue:
+            color, timestamp, line = self.queue.popleft()
+            try:
+                print(f"{color}{line}", end='')
+                if self._open_file():
+                    self.file.write(f"{timestamp} {line}")
+                    if self.file.tell() >= Logger.ROTATE_BYTES:
+                        self._rotate()
+                self.written += 1
+                count += 1
+            except BaseException:
+                pass
+        return count
+
+    def _open_file(self):
+        if self.file is None and isinstance(self.log_file_path, str) and len(self.log_file_path) > 0:
+            self.file = open(self.log_file_path, 'a', encoding=Logger.__file_encoding)
+        return self.file is not None
+
+    def _flush(self):
+        try:
+            if self.file:
+                self.file.flush()
+        except BaseException:
+            pass
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(Logger.ROTATE_BACKUPS - 1, 0, -1):
+            src = f"{self.log_file_path}.{i}"
+            if os.path.isfile(src):
+                os.replace(src, f"{self.log_file_path}.{i + 1}")
+        if Logger.ROTATE_BACKUPS > 0:
+            os.replace(self.log_file_path, f"{self.log_file_path}.1")
+        else:
+            os.remove(self.log_file_path)
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self.thread.join(1)
+            # The writer may still be running if the join timed out
+            with self._io_lock:
+                self._drain()
+                self._flush()
+                if self.file:
+                    self.file.close()
+                    self.file = None
 
     def _set_level(self, level:int):
         self.log_level = level
 
     def _log(self, tag:str, msg:str):
         try:
-            with self.internal_lock:
-                color = '\033[31m' if tag == 'ERROR' else '\033[33m' if tag == 'WARN' else '\033[37m'
-                print(f"{color}[{tag}] {msg}")
-                self.queue.append(f"{datetime.now().strftime(Logger.__time_format)} [{tag}] {msg}\n")
-                self.internal_lock.notify_all()
+            backlog = len(self.queue)
+            if backlog >= Logger.QUEUE_HARD_LIMIT and tag != 'ERROR' or \
+                    backlog >= Logger.QUEUE_SOFT_LIMIT and tag == 'DEBUG':
+                self.dropped += 1
+                return
+            color = '\033[31m' if tag == 'ERROR' else '\033[33m' if tag == 'WARN' else '\033[37m'
+            self.queue.append((color, datetime.now().strftime(Logger.__time_format), f"[{tag}] {msg}\n"))
+            self.queued += 1
+            self._wakeup.set()
         except BaseException:
             pass
 
+    def _stats(self):
+        return {'queued': self.queued, 'written': self.written, 'dropped': self.dropped, 'backlog': len(self.queue)}
+
     def _error(self, msg:str):
         if self.log_level >= Logger.LV_ERROR:
             self._log('ERROR', msg)
@@ -83,13 +169,16 @@ class Logger():
     @staticmethod
     def set_instance_override(log_file_path:str, level:int=LV_INFO):
         """Initializes the Logger static instance forcibly.
-        If the instance has been initialized yet, this method will override it.
+        If the instance has been initialized yet, this method will override it and close the previous one.
 
         :param log_file_path: The path to the log file;
         :param level: The logging level;
         :rtype: None;
         """
+        previous = Logger.__instance
         Logger.__instance = Logger(log_file_path, level)
+        if previous:
+            previous._close()
 
     @staticmethod
     def set_level(level:int):
@@ -101,6 +190,26 @@ class Logger():
         if Logger.__instance:
             Logger.__instance._set_level(level)
 
+    @staticmethod
+    def stats():
+        """Gets the counters of queued, written and dropped lines.
+
+        :returns: A dict of the counters, `None` if the instance is not initialized;
+        :rtype: dict|None;
+        """
+        if Logger.__instance:
+            return Logger.__instance._stats()
+        return None
+
+    @staticmethod
+    def close():
+        """Writes all the pending lines and closes the log file.
+
+        :rtype: None;
+        """
+        if Logger.__instance:
+            Logger.__instance._close()
+
     @staticmethod
     def log(tag:str, msg:str):
         if Logger.__instance:
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import pytest
+import Benchmark
+from src.Recognizer import Recognizer
+
+
+@pytest.fixture(scope='module')
+def frames():
+    return Benchmark.synthesize_frames()[0]
+
+
+@pytest.mark.parametrize('ocr_mode', Benchmark.OCR_MODES)
+@pytest.mark.parametrize('engine', tuple(Recognizer.ENGINES))
+def test_steady_state_allocations(frames, engine, ocr_mode):
+    # The result pipes of the process pool hold a bounded amount of memory at any moment,
+    # so enough passes are needed to tell it from the growth
+    report = Benchmark.measure_allocations(frames, engine=engine, repeat=30, ocr_mode=ocr_mode, workers=2)
+    assert report['growth_bytes_per_frame'] <= Benchmark.ALLOC_GROWTH_LIMIT, report['growth_sites']
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Harry Huang
+# @ MIT License
+import os
+import shutil
+import subprocess
+import time
+import pytest
+from src.Poller import AdaptivePoller, DamagePoller, create_poller
+
+pytest.importorskip('Xlib', reason="python-xlib is not installed")
+if shutil.which('Xvfb') is None:
+    pytest.skip("Xvfb is not installed", allow_module_level=True)
+
+from Xlib import display
+
+RECT = (40, 40, 120, 80) # (left, top, right, bottom)
+MAX_INTERVAL = 1.0
+
+
+def _start_xvfb(monkeypatch, *args:str):
+    # Xvfb writes the display number to the given fd once it is ready to accept connections
+    read_fd, write_fd = os.pipe()
+    proc = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-screen', '0', '320x240x24', '-nolisten', 'tcp',
+                             *args], pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        number = f.readline().strip()
+    if not number:
+        proc.wait()
+        pytest.skip("Xvfb failed to start")
+    monkeypatch.setenv('DISPLAY', f":{number}")
+    return proc
+
+
+def _stop_xvfb(proc:subprocess.Popen):
+    proc.terminate()
+    proc.wait(5)
+
+
+@pytest.fixture
+def xvfb(monkeypatch):
+    proc = _start_xvfb(monkeypatch)
+    yield
+    _stop_xvfb(proc)
+
+
+@pytest.fixture
+def xvfb_without_damage(monkeypatch):
+    proc = _start_xvfb(monkeypatch, '-extension', 'DAMAGE')
+    yield
+    _stop_xvfb(proc)
+
+
+@pytest.fixture
+def window(xvfb):
+    d = display.Display()
+    screen = d.screen()
+    w = screen.root.create_window(0, 0, screen.width_in_pixels, screen.height_in_pixels, 0, screen.root_depth,
+                                  background_pixel=screen.black_pixel, override_redirect=True)
+    w.map()
+    d.sync()
+    yield d, w, w.create_gc(foreground=screen.white_pixel)
+    d.close()
+
+
+@pytest.fixture
+def poller(window):
+    p = DamagePoller(RECT, max_interval=MAX_INTERVAL)
+    p.report(AdaptivePoller.IDLE)
+    # Waits out the damage of mapping the window
+    while p.wait():
+        pass
+    yield p
+    p.close()
+
+
+def _repaint(window:tuple, x:int, y:int, width:int, height:int):
+    d, w, gc = window
+    w.fill_rectangle(gc, x, y, width, height)
+    d.sync()
+
+
+def test_repaint_inside_wakes_up(window, poller):
+    hits = poller.damage_hits
+    begin = time.monotonic()
+    _repaint(window, RECT[0] + 10, RECT[1] + 10, 20, 20)
+    assert poller.wait()
+    assert time.monotonic() - begin < MAX_INTERVAL
+    assert poller.damage_hits > hits
+
+
+def test_repaint_outside_does_not_wake_up(window, poller):
+    events, hits = poller.damage_events, poller.damage_hits
+    _repaint(window, RECT[2] + 10, RECT[3] + 10, 20, 20)
+    assert not poller.wait()
+    assert poller.damage_events > events
+    assert poller.damage_hits == hits
+
+
+def test_falls_back_without_damage_extension(xvfb_without_damage):
+    d = display.Display()
+    try:
+        assert not d.has_extension('DAMAGE')
+    finally:
+        d.close()
+    p = create_poller("damage", RECT, max_interval=MAX_INTERVAL)
+    try:
+        assert type(p) is AdaptivePoller
+    finally:
+        p.close()